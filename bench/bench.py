@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# benchmarks the interpreter on the examples, the standard libraries and
+# synthetic boards of growing size, checking what every case prints against
+# its golden file and comparing run times with a saved baseline
+
+import os
+import sys
+import time
+import json
+import random
+import argparse
+import resource
+import multiprocessing
+try:
+    from Queue import Empty
+except ImportError:  # python 3.x
+    from queue import Empty
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+root_dir = os.path.dirname(bench_dir)
+sys.path.insert(0, root_dir)
+from marbelous.marbelous import load_program, default_options, MarbelousError
+
+golden_dir = os.path.join(bench_dir, 'golden')
+
+# examples and libraries with the inputs they are benchmarked on, leaving out
+# the ones that wait on stdin forever or don't parse
+file_cases = [
+    ('adder_3_4', 'examples/adder.mbl', [3, 4]),
+    ('adder_200_100', 'examples/adder.mbl', [200, 100]),
+    ('conveyor_36', 'examples/conveyor_36.mbl', [7]),
+    ('day_of_week', 'examples/day-of-week.mbl', [3]),
+    ('day_of_week2', 'examples/day-of-week2.mbl', [5]),
+    ('dragon_13', 'examples/dragon_fractal_position.mbl', [13]),
+    ('fourwayincrement', 'examples/fourwayincrement.mbl', [9]),
+    ('helloworld', 'examples/helloworld.mbl', []),
+    ('helloworld2', 'examples/helloworld2.mbl', []),
+    ('powersofi_3', 'examples/powersofi.mbl', [3]),
+    ('threewaysplit', 'examples/threewaysplit.mbl', [5]),
+    ('lib_arithmetic', 'lib/arithmetic.mbl', [100, 50, 1]),
+    ('lib_bin_out', 'lib/bin_out.mbl', [170]),
+    ('lib_bitwise_operations', 'lib/bitwise_operations.mbl', [12, 10]),
+    ('lib_dec_out', 'lib/dec_out.mbl', [234]),
+    ('lib_flipflops', 'lib/flipflops.mbl', []),
+    ('lib_hex_out', 'lib/hex_out.mbl', [171]),
+    ('lib_logical_operations', 'lib/logical_operations.mbl', [5, 0]),
+    ('lib_marble_movement', 'lib/marble_movement.mbl', []),
+    ('lib_wide_devices', 'lib/wide_devices.mbl', [6, 7]),
+]
+
+# scaling benchmarks, recursive fibonacci by n, grids by width x height and
+# conveyors by how many marbles they carry
+fib_sizes = [5, 10, 15, 20, 25]
+grid_sizes = [(16, 8), (64, 8), (256, 8), (16, 32), (16, 90), (128, 64), (256, 90)]
+conveyor_sizes = [16, 64, 256]
+
+# a main board of width columns of marbles falling through height
+# incrementers, each printing chr(32 + height) off the bottom
+def grid_board(width, height):
+    rows = [' '.join(['20'] * width)]
+    rows += [' '.join(['++'] * width)] * height
+    return '\n'.join(rows) + '\n'
+
+# a main board of count marbles carried right along a row of deflectors twice
+# as long, falling off the end one after another to print an A each
+def conveyor_board(count):
+    length = count * 2
+    rows = [' '.join(['41'] * count + ['..'] * (length - count + 1)),
+            ' '.join(['\\\\'] * length + ['..'])]
+    return '\n'.join(rows) + '\n'
+
+# every case as (name, file name or source, inputs)
+def all_cases():
+    cases = list(file_cases)
+    cases += [('fib_' + str(n), 'examples/fibonacci.mbl', [n]) for n in fib_sizes]
+    cases += [('grid_' + str(w) + 'x' + str(h), grid_board(w, h), []) for w, h in grid_sizes]
+    cases += [('conveyor_' + str(n), conveyor_board(n), []) for n in conveyor_sizes]
+    return cases
+
+# loads and runs one case, in a process of its own so its peak memory is its
+# own, putting what it measured on queue
+def run_case(case, options, seed, queue):
+    name, source, inputs = case
+    random.seed(seed)
+    try:
+        start = time.time()
+        program = load_program(source, **options)
+        loaded = time.time()
+        result = program.run(inputs)
+        finished = time.time()
+        program.close()
+    except MarbelousError as e:
+        queue.put({'error': str(e)})
+        return
+    except Exception as e:
+        # a crash in the interpreter, reported as one rather than a time out
+        queue.put({'error': 'crashed with ' + type(e).__name__ + ': ' + str(e)})
+        return
+    queue.put({
+        'stdout': result.stdout,
+        'ticks': result.ticks,
+        'load_seconds': loaded - start,
+        'seconds': finished - loaded,
+        'memory_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        })
+
+# what a case's process put on queue, or why it put nothing: the process
+# died, say killed for its memory, or it ran for more than timeout seconds
+def wait_for_case(process, queue, timeout):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return queue.get(timeout=0.1)
+        except Empty:
+            pass
+        if not process.is_alive():
+            try:
+                return queue.get(timeout=1)  # put just before it exited
+            except Empty:
+                if process.exitcode < 0:
+                    return {'error': 'crashed, killed by signal ' + str(-process.exitcode)}
+                return {'error': 'crashed with exit code ' + str(process.exitcode)}
+        if time.time() > deadline:
+            process.terminate()
+            return {'error': 'timed out after ' + str(timeout) + 's'}
+
+# fastest of repeat runs of a case, or what went wrong
+def measure(case, options, seed, repeat, timeout):
+    best = None
+    for i in range(repeat):
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run_case, args=(case, options, seed, queue))
+        process.start()
+        measurement = wait_for_case(process, queue, timeout)
+        process.join()
+        if 'error' in measurement:
+            return measurement
+        if best is None or measurement['seconds'] < best['seconds']:
+            best = measurement
+    return best
+
+# compares stdout with the case's golden file, or replaces the golden file
+def check_golden(name, stdout, update):
+    filename = os.path.join(golden_dir, name + '.out')
+    if update:
+        if not os.path.isdir(golden_dir):
+            os.makedirs(golden_dir)
+        with open(filename, 'wb') as f:
+            f.write(stdout)
+        return 'saved'
+    if not os.path.isfile(filename):
+        return 'no golden'
+    with open(filename, 'rb') as f:
+        return 'ok' if f.read() == stdout else 'FAIL'
+
+parser = argparse.ArgumentParser(description='Benchmark the Marbelous interpreter.')
+parser.add_argument('-k', metavar='PATTERN', dest='pattern', action='store',
+                    help='only run cases with PATTERN in their name')
+parser.add_argument('--list', dest='list', action='store_true',
+                    help='list the cases and exit')
+parser.add_argument('--repeat', metavar='N', dest='repeat', action='store', type=int, default=1,
+                    help='run each case N times and keep the fastest')
+parser.add_argument('--seed', metavar='N', dest='seed', action='store', type=int, default=0,
+                    help='seed for the random devices, default 0')
+parser.add_argument('--timeout', metavar='SECONDS', dest='timeout', action='store', type=float, default=60,
+                    help='give up on a case after SECONDS, default 60')
+parser.add_argument('--baseline', metavar='FILE', dest='baseline', action='store',
+                    default=os.path.join(bench_dir, 'baseline.json'),
+                    help='baseline to compare times with, default bench/baseline.json')
+parser.add_argument('--save-baseline', dest='save_baseline', action='store_true',
+                    help='save these results as the baseline')
+parser.add_argument('--update-golden', dest='update_golden', action='store_true',
+                    help='save the outputs as the golden files')
+parser.add_argument('--json', metavar='FILE', dest='json', action='store',
+                    help='also write the results to FILE as JSON')
+parser.add_argument('-m', metavar='W', dest='memoize_width', action='store', type=int, default=default_options['memoize_width'],
+                    help='interpreter memoize width, see marbelous.py -h')
+parser.add_argument('--memo-size', metavar='N', dest='memo_size', action='store', type=int, default=default_options['memo_size'],
+                    help='interpreter memo table size')
+parser.add_argument('--precompile', metavar='N', dest='precompile', action='store', type=int, default=default_options['precompile'],
+                    help='interpreter precompile inputs')
+parser.add_argument('--cache-dir', metavar='DIR', dest='cache_dir', action='store',
+                    help='interpreter cache directory for precompiled tables')
+parser.add_argument('-j', '--jobs', metavar='N', dest='jobs', action='store', type=int, default=default_options['jobs'],
+                    help='interpreter worker processes')
+parser.add_argument('--numpy', dest='numpy', action='store_true',
+                    help='use the interpreter\'s numpy backend')
+parser.add_argument('--jit', dest='jit', action='store_true',
+                    help='compile boards with the interpreter\'s jit option')
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    cases = [case for case in all_cases() if not args.pattern or args.pattern in case[0]]
+    if args.list:
+        for case in cases:
+            sys.stdout.write(case[0] + '\n')
+        return 0
+    # includes are searched for from the working directory
+    os.chdir(root_dir)
+    # parsing is measured on every run, not loaded from the program cache
+    options = {
+        'program_cache': False,
+        'memoize_width': args.memoize_width,
+        'memo_size': args.memo_size,
+        'precompile': args.precompile,
+        'cache_dir': args.cache_dir,
+        'jobs': args.jobs,
+        'numpy': args.numpy,
+        'jit': args.jit,
+        }
+    baseline = {}
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    failed = False
+    sys.stdout.write('%-24s %-9s %10s %9s %10s %9s %8s\n' % ('case', 'output', 'ticks', 'load_ms', 'run_ms', 'peak_kb', 'speedup'))
+    for case in cases:
+        name = case[0]
+        measurement = measure(case, options, args.seed, args.repeat, args.timeout)
+        if 'error' in measurement:
+            sys.stdout.write('%-24s error: %s\n' % (name, measurement['error']))
+            failed = True
+            continue
+        status = check_golden(name, measurement.pop('stdout'), args.update_golden)
+        failed = failed or status == 'FAIL'
+        speedup = ''
+        if name in baseline and measurement['seconds'] > 0:
+            speedup = '%.2fx' % (baseline[name]['seconds'] / measurement['seconds'])
+        sys.stdout.write('%-24s %-9s %10d %9.1f %10.1f %9d %8s\n' % (name, status, measurement['ticks'],
+                         measurement['load_seconds'] * 1000, measurement['seconds'] * 1000, measurement['memory_kb'], speedup))
+        sys.stdout.flush()
+        measurement['output'] = status
+        results[name] = measurement
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=1, separators=(',', ': '), sort_keys=True)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1, separators=(',', ': '), sort_keys=True)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
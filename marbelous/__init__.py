@@ -0,0 +1 @@
+from .marbelous import load_program, Program, Result, MarbelousError, Stopped, save_snapshot, load_snapshot
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# runs a Marbelous file on a daemon started with daemon.py, taking the same
+# arguments as marbelous.py and printing what it would, without paying for
+# starting the interpreter and loading the program on every run
+
+import os
+import sys
+import json
+import socket
+import argparse
+
+# socket the daemon listens on unless told otherwise
+def default_socket():
+    return os.environ.get('MARBELOUS_SOCKET') or '/tmp/marbelous-' + str(os.getuid()) + '.sock'
+
+# sends a request to the daemon, returning its response
+def send(path, request):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+        s.sendall(json.dumps(request).encode('latin-1') + b'\n')
+        s.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = s.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        s.close()
+    return json.loads(b''.join(chunks).decode('latin-1'))
+
+parser = argparse.ArgumentParser(description='Run a Marbelous file on a daemon started with daemon.py.')
+parser.add_argument('file', metavar='filename.mbl', nargs='?',
+                    help='filename for the main board file')
+parser.add_argument('inputs', metavar='input', nargs='*',
+                    help='inputs for the main board')
+parser.add_argument('-r', '--return', dest='return', action='store_true',
+                    help='main board {0 as process return code')
+parser.add_argument('--max-ticks', metavar='N', dest='max_ticks', action='store', type=int,
+                    help='stop the run after N ticks across all boards')
+parser.add_argument('--max-time', metavar='SECONDS', dest='max_time', action='store', type=float,
+                    help='stop the run after SECONDS of wall time')
+parser.add_argument('--socket', metavar='PATH', dest='socket', action='store', default=default_socket(),
+                    help='socket the daemon listens on, default $MARBELOUS_SOCKET or /tmp/marbelous-UID.sock')
+parser.add_argument('--stats', dest='stats', action='store_true',
+                    help="print the daemon's run count, throughput and latency and exit")
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    if not args.stats and args.file is None:
+        parser.error('a filename is required')
+    if args.stats:
+        request = {'stats': True}
+    else:
+        request = {
+            'file': os.path.abspath(args.file),
+            'cwd': os.getcwd(),  # includes are searched for from here too
+            'inputs': args.inputs,
+            'stdin': None,
+            'max_ticks': args.max_ticks,
+            'max_time': args.max_time,
+            }
+    try:
+        response = send(args.socket, request)
+        if response.get('needs_stdin'):
+            # the program reads stdin, which is sent whole as the daemon
+            # can't wait on it, a terminal up to end of file
+            stdin = getattr(sys.stdin, 'buffer', sys.stdin).read()
+            request['stdin'] = stdin.decode('latin-1')  # marbles are bytes, not text
+            response = send(args.socket, request)
+    except (IOError, OSError, ValueError) as e:
+        sys.stderr.write("can't reach the daemon on " + args.socket + ": " + str(e) + "\n")
+        exit(1)
+
+    if args.stats:
+        sys.stdout.write(str(response['runs']) + " runs, " + str(response['errors']) + " errors, " + \
+                         str(response['stopped']) + " stopped in " + '%.1f' % response['uptime'] + "s\n")
+        if response['window']:
+            sys.stdout.write("last " + str(response['window']) + " runs: " + '%.1f' % response['runs_per_second'] + " runs/s, " + \
+                             "latency p50 " + '%.2f' % response['p50_ms'] + "ms, p99 " + '%.2f' % response['p99_ms'] + "ms, " + \
+                             "max " + '%.2f' % response['max_ms'] + "ms\n")
+        exit(0)
+
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+    stdout.write(response.get('stdout', '').encode('latin-1'))
+    stdout.flush()
+    if 'error' in response or 'stopped' in response:
+        sys.stderr.write(response.get('error', response.get('stopped')) + "\n")
+        exit(1)
+    # as marbelous.py -r, boards without outputs print a newline instead
+    if args.__dict__['return'] and response['return'] is not None:
+        exit(response['return'])
+    print('')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+# serves runs of Marbelous programs on a unix socket for client.py, from a
+# pool of worker processes that keep each program they load, parsed and
+# with its memo tables, for the runs that follow
+
+from __future__ import absolute_import  # so marbelous below is the package, not the module beside this one, on python 2.x
+
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import argparse
+import itertools
+import threading
+import multiprocessing
+from collections import deque
+try:
+    import SocketServer as socketserver
+except ImportError:  # python 3.x
+    import socketserver
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_dir)
+from marbelous.marbelous import load_program, sources_changed, default_options, MarbelousError, Stopped
+from marbelous.client import default_socket
+
+# runs the latency and throughput stats are worked out over
+stats_window = 10000
+
+# seconds past a run's time budget the daemon waits for its response, for
+# loading the program and the ticks between budget checks
+response_grace = 60
+
+# the options programs are loaded with, the programs loaded so far by
+# (file, working directory) and the queue telling the daemon which worker
+# took which request, in each worker process
+worker_options = None
+worker_programs = {}
+worker_started = None
+
+def init_worker(options, preload, started):
+    global worker_options, worker_started
+    worker_options = options
+    worker_started = started
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the daemon stops the pool itself
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)  # Pool.terminate stops workers with SIGTERM
+    for filename in preload:
+        try:
+            resident_program(os.path.abspath(filename), os.getcwd())
+        except MarbelousError:
+            pass  # the client asking for it gets the error
+
+# the program loaded from filename in cwd, loaded again if any of its
+# files has changed since
+def resident_program(filename, cwd):
+    key = (filename, cwd)
+    program = worker_programs.get(key)
+    if program is not None and sources_changed(program.sources):
+        program.close()
+        program = None
+    if program is None:
+        # includes are searched for from the working directory too
+        os.chdir(cwd)
+        program = load_program(filename, **worker_options)
+        worker_programs[key] = program
+    return program
+
+# collects a run's stdout, stopping the run once it has written more than
+# limit bytes and keeping only the first limit of them
+class CappedOutput(object):
+    def __init__(self, limit):
+        self.chunks = []
+        self.size = 0
+        self.limit = limit
+        self.execution = None
+
+    def write(self, data):
+        if self.size < self.limit:
+            self.chunks.append(data[:self.limit - self.size])
+        self.size += len(data)
+        if self.size > self.limit:
+            self.execution.stop("wrote more than its " + str(self.limit) + " byte limit")
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        return b''.join(self.chunks)
+
+# runs the main board of a request's program in a worker process, the
+# request's budgets apply to this run only, and a request without stdin for
+# a program that reads it is sent back for the client to read its stdin
+def serve_run(request, number):
+    worker_started.put((number, os.getpid()))
+    output = CappedOutput(request['max_output'])
+    try:
+        filename, cwd = str(request['file']), str(request['cwd'])
+        program = resident_program(filename, cwd)
+        if request.get('stdin') is None and program.reads_stdin():
+            return {'needs_stdin': True}
+        options = program.options
+        options['max_ticks'] = request.get('max_ticks')
+        options['max_time'] = request.get('max_time')
+        try:
+            output.execution = program.start([str(x) for x in request['inputs']], (request.get('stdin') or '').encode('latin-1'), output)
+            result = output.execution.finish()
+        finally:
+            options['max_ticks'] = options['max_time'] = None
+    except Stopped as e:
+        return {'stopped': str(e), 'stdout': output.getvalue().decode('latin-1')}
+    except MarbelousError as e:
+        return {'error': str(e)}
+    except Exception as e:
+        # a run that broke the interpreter leaves nothing to trust behind
+        worker_programs.pop((str(request.get('file')), str(request.get('cwd'))), None)
+        return {'error': type(e).__name__ + ": " + str(e)}
+    return {
+        'stdout': output.getvalue().decode('latin-1'),  # marbles are bytes, not text
+        'outputs': dict((str(n), v) for n, v in result.outputs.items()),
+        # the -r return code, None if the main board has no outputs
+        'return': result.return_code() if len(result.frame.board.outputs) else None,
+        'ticks': result.ticks,
+        }
+
+# json strings, str or unicode on python 2.x
+text_types = (str, type(u''))
+
+# what's wrong with a run request, None if it's fine
+def request_error(request):
+    for field in ('file', 'cwd'):
+        if not isinstance(request.get(field), text_types):
+            return "the request needs a " + field + " string"
+    inputs = request.get('inputs')
+    if not isinstance(inputs, list) or not all(isinstance(x, text_types + (int,)) for x in inputs):
+        return "the request needs a list of inputs"
+    for field in ('max_ticks', 'max_time'):
+        if request.get(field) is not None and not isinstance(request[field], (int, float)):
+            return "the request's " + field + " isn't a number"
+    if request.get('stdin') is not None and not isinstance(request['stdin'], text_types):
+        return "the request's stdin isn't a string"
+    return None
+
+# the budget a run gets, the daemon's default if the request gives none,
+# and never more than its limit
+def budget(requested, default, limit):
+    value = default if requested is None else requested
+    if limit is not None and (value is None or value > limit):
+        return limit
+    return value
+
+# whether a worker process is still there
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+# run count and the latency of recent runs, from a request arriving to its
+# response being ready
+class Stats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.runs = 0
+        self.errors = 0
+        self.stopped = 0
+        # (start, seconds) of the last stats_window runs
+        self.window = deque(maxlen=stats_window)
+
+    def record(self, start, response):
+        with self.lock:
+            self.runs += 1
+            self.errors += 'error' in response
+            self.stopped += 'stopped' in response
+            self.window.append((start, time.time() - start))
+
+    def report(self):
+        with self.lock:
+            window = list(self.window)
+            report = {'runs': self.runs, 'errors': self.errors, 'stopped': self.stopped,
+                      'uptime': time.time() - self.started, 'window': len(window)}
+        if window:
+            latencies = sorted(seconds for start, seconds in window)
+            def percentile(p):
+                return latencies[max(0, int(len(latencies) * p + 0.5) - 1)] * 1000
+            busy = max(start + seconds for start, seconds in window) - window[0][0]
+            report.update({
+                'runs_per_second': len(window) / busy if busy > 0 else 0.0,
+                'p50_ms': percentile(0.5),
+                'p99_ms': percentile(0.99),
+                'max_ms': latencies[-1] * 1000,
+                })
+        return report
+
+# a request is a line of JSON and so is its response, clients are served in
+# threads of their own while their runs wait for a worker
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        start = time.time()
+        try:
+            request = json.loads(self.rfile.readline().decode('latin-1'))
+        except ValueError as e:
+            self.respond({'error': "bad request: " + str(e)})
+            return
+        if not isinstance(request, dict):
+            self.respond({'error': "bad request: not a JSON object"})
+            return
+        if request.get('stats'):
+            self.respond(self.server.stats.report())
+            return
+        error = request_error(request)
+        if error is not None:
+            self.respond({'error': "bad request: " + error})
+            return
+        server = self.server
+        request['max_ticks'] = budget(request.get('max_ticks'), server.max_ticks, server.limit_ticks)
+        request['max_time'] = budget(request.get('max_time'), server.max_time, server.limit_time)
+        request['max_output'] = server.limit_output
+        response = self.wait(request)
+        if 'needs_stdin' not in response:
+            server.stats.record(start, response)
+        self.respond(response)
+
+    # runs a request in a worker, giving up if the worker dies or takes
+    # much longer than the request's time budget
+    def wait(self, request):
+        server = self.server
+        number = next(server.numbers)
+        result = server.pool.apply_async(serve_run, (request, number))
+        deadline = None if request['max_time'] is None else time.time() + request['max_time'] + response_grace
+        try:
+            while not result.ready():
+                result.wait(1)
+                pid = server.workers.get(number)
+                if pid is not None and not result.ready() and not process_alive(pid):
+                    return {'error': "the worker running " + request['file'] + " died"}
+                if deadline is not None and time.time() > deadline:
+                    return {'error': "no response from the worker running " + request['file'] + " after " + \
+                                     str(request['max_time'] + response_grace) + "s"}
+            try:
+                return result.get()
+            except Exception as e:  # raised in the worker outside serve_run's own handling
+                return {'error': type(e).__name__ + ": " + str(e)}
+        finally:
+            server.workers.pop(number, None)
+
+    def respond(self, response):
+        try:
+            self.wfile.write(json.dumps(response, sort_keys=True).encode('latin-1') + b'\n')
+            self.wfile.flush()
+        except (IOError, OSError):
+            pass  # the client has gone
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, pool, started, args):
+        socketserver.UnixStreamServer.__init__(self, path, Handler)
+        self.pool = pool
+        self.stats = Stats()
+        self.max_ticks, self.max_time = args.max_ticks, args.max_time
+        self.limit_ticks, self.limit_time, self.limit_output = args.limit_ticks, args.limit_time, args.limit_output
+        # numbers requests are told apart by, and the worker each is on
+        self.numbers = itertools.count()
+        self.workers = {}
+        self.started = started
+        thread = threading.Thread(target=self.collect_started)
+        thread.daemon = True
+        thread.start()
+
+    # notes which worker each request went to, as they start
+    def collect_started(self):
+        while True:
+            number, pid = self.started.get()
+            self.workers[number] = pid
+
+parser = argparse.ArgumentParser(description='Serve runs of Marbelous programs to client.py.')
+parser.add_argument('preload', metavar='filename.mbl', nargs='*',
+                    help='programs for every worker to load before the first request')
+parser.add_argument('--socket', metavar='PATH', dest='socket', action='store', default=default_socket(),
+                    help='socket to listen on, default $MARBELOUS_SOCKET or /tmp/marbelous-UID.sock')
+parser.add_argument('-j', '--jobs', metavar='N', dest='jobs', action='store', type=int, default=multiprocessing.cpu_count(),
+                    help='worker processes running programs, default one per CPU')
+parser.add_argument('--max-ticks', metavar='N', dest='max_ticks', action='store', type=int,
+                    help='tick budget for runs that ask for none, default none')
+parser.add_argument('--max-time', metavar='SECONDS', dest='max_time', action='store', type=float, default=60,
+                    help='time budget for runs that ask for none, default 60')
+parser.add_argument('--limit-ticks', metavar='N', dest='limit_ticks', action='store', type=int,
+                    help='most ticks a run may ask for, default no limit')
+parser.add_argument('--limit-time', metavar='SECONDS', dest='limit_time', action='store', type=float, default=600,
+                    help='most seconds a run may ask for, default 600')
+parser.add_argument('--limit-output', metavar='BYTES', dest='limit_output', action='store', type=int, default=64 << 20,
+                    help='stop runs that write more than BYTES to stdout, default 64MB')
+parser.add_argument('-m', metavar='W', dest='memoize_width', action='store', type=int, default=default_options['memoize_width'],
+                    help='interpreter memoize width, see marbelous.py -h')
+parser.add_argument('--memo-size', metavar='N', dest='memo_size', action='store', type=int, default=default_options['memo_size'],
+                    help='interpreter memo table size')
+parser.add_argument('--precompile', metavar='N', dest='precompile', action='store', type=int, default=default_options['precompile'],
+                    choices=range(3), help='interpreter precompile inputs')
+parser.add_argument('--cache-dir', metavar='DIR', dest='cache_dir', action='store',
+                    help='interpreter cache directory for precompiled tables')
+parser.add_argument('--numpy', dest='numpy', action='store_true',
+                    help="use the interpreter's numpy backend")
+parser.add_argument('--jit', dest='jit', action='store_true',
+                    help="compile boards with the interpreter's jit option")
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    options = {
+        'memoize_width': args.memoize_width,
+        'memo_size': args.memo_size,
+        'precompile': args.precompile,
+        'cache_dir': args.cache_dir,
+        'numpy': args.numpy,
+        'jit': args.jit,
+        'flush': 'size',  # so CappedOutput sees stdout as it grows
+        }
+    if os.path.exists(args.socket):
+        # a daemon that's still running would take the connection
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(args.socket)
+            sys.stderr.write("a daemon is already listening on " + args.socket + "\n")
+            exit(1)
+        except (IOError, OSError):
+            os.remove(args.socket)
+        finally:
+            probe.close()
+    started = multiprocessing.Queue()
+    pool = multiprocessing.Pool(args.jobs, init_worker, (options, args.preload, started))
+    server = Server(args.socket, pool, started, args)
+    signal.signal(signal.SIGTERM, lambda signum, frame: exit(0))
+    sys.stderr.write("listening on " + args.socket + " with " + str(args.jobs) + " workers\n")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+        pool.terminate()
+        report = server.stats.report()
+        sys.stderr.write(str(report['runs']) + " runs served")
+        if report['window']:
+            sys.stderr.write(", p99 latency " + '%.2f' % report['p99_ms'] + "ms")
+        sys.stderr.write("\n")
+
+if __name__ == '__main__':
+    main()
@@ -2,15 +2,35 @@
 
 import os
 import sys
-import copy     # to duplicate board objects
+import time
 import random   # for portals and random devices
+import hashlib  # for persistent memo file names
+import json     # for batch results
+import itertools # for batch input ranges
+import tempfile # for atomic memo file writes
+import signal   # for flushing stdout when terminated
+import stat     # for telling regular files from pipes on stdin, and who can write cached files
+import mmap     # for reading regular files on stdin
 import argparse # for command line arguments
+import gzip # for compressed traces
+import multiprocessing # for evaluating function calls in parallel
+import weakref # for the runs Program.stop stops
+from array import array # for compiled device grids
 from collections import deque # for stdout queuing
+from collections import OrderedDict # for least recently used memo eviction
+try:
+    import cPickle as pickle # for persistent memo files
+except ImportError:
+    import pickle  # python 3.x
+try:
+    from cStringIO import StringIO as BytesIO # for capturing stdout of parallel calls
+except ImportError:
+    from io import BytesIO  # python 3.x
 from threading import Thread # for non-blocking stdin
 try:
-    from Queue import Queue, Empty # for non-blocking stdin
+    from Queue import Empty # for non-blocking stdin
 except ImportError:
-    from queue import Queue, Empty  # python 3.x
+    from queue import Empty  # python 3.x
 
 
 
@@ -18,6 +38,34 @@ oct_digits = '01234567'
 hex_digits = '0123456789ABCDEF'
 b36_digits = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
 
+# when Output writes buffered stdout to its stream
+flush_policies = ('size', 'line', 'exit')
+
+# bytes of stdout buffered before a write, for the size and line policies
+flush_size = 65536
+
+# interpreter options a program is loaded with, see load_program
+default_options = {
+    'verbose': 0,
+    'stderr': False,
+    'memoize_width': 2,
+    'memo_size': 65536,
+    'memo_dir': None,
+    'precompile': 0,
+    'cache_dir': None,
+    'jobs': 1,
+    'numpy': False,
+    'flush': None,
+    'program_cache': False,
+    'profile': None,
+    'trace': None,
+    'trace_every': 1,
+    'max_ticks': None,
+    'max_time': None,
+    'max_memory': None,
+    'jit': False,
+    }
+
 parser = argparse.ArgumentParser(description='Interpret a Marbelous file.')
 
 parser.add_argument('file', metavar='filename.mbl',
@@ -26,17 +74,57 @@ parser.add_argument('inputs', metavar='input', nargs='*',
                     help='inputs for the main board')
 parser.add_argument('-r', '--return', dest='return', action='store_true',
                     help='main board {0 as process return code')
-parser.add_argument('-v', '--verbose', dest='verbose', action='count', default=0,
+parser.add_argument('-v', '--verbose', dest='verbose', action='count', default=default_options['verbose'],
                     help='operate in verbose mode, -vv -vvv -vvvv increase verbosity')
 parser.add_argument('--stderr', dest='stderr', action='store_true',
                     help='send verbose output to stderr instead of stdout')
-parser.add_argument('-m', metavar='W', dest='memoize_width', action='store', type=int, default=2,
+parser.add_argument('-m', metavar='W', dest='memoize_width', action='store', type=int, default=default_options['memoize_width'],
                     help='maximum function width to memoize')
+parser.add_argument('--memo-size', metavar='N', dest='memo_size', action='store', type=int, default=default_options['memo_size'],
+                    help='maximum memoized results kept per board, 0 for unbounded')
+parser.add_argument('--memo-dir', metavar='DIR', dest='memo_dir', action='store',
+                    help='directory to load and save memoized results across runs')
+parser.add_argument('--precompile', metavar='N', dest='precompile', action='store', type=int, default=default_options['precompile'],
+                    choices=range(3), help='precompute lookup tables for pure boards with up to N inputs')
+parser.add_argument('--cache-dir', metavar='DIR', dest='cache_dir', action='store',
+                    help='directory for cached programs and precompiled tables, default $XDG_CACHE_HOME/marbelous or ~/.cache/marbelous')
+parser.add_argument('--no-program-cache', dest='program_cache', action='store_false',
+                    help="don't load or save the parsed program in the cache dir")
+parser.add_argument('-j', '--jobs', metavar='N', dest='jobs', action='store', type=int, default=default_options['jobs'],
+                    help='evaluate independent function calls in N worker processes')
+parser.add_argument('--numpy', dest='numpy', action='store_true',
+                    help='move marbles on simple devices with whole-array numpy operations')
+parser.add_argument('--jit', dest='jit', action='store_true',
+                    help='compile each board to a Python function with its devices written out')
+parser.add_argument('--flush', metavar='WHEN', dest='flush', action='store', choices=flush_policies,
+                    help='when to write buffered stdout: size, line or exit, default line on a terminal and size otherwise')
+parser.add_argument('--batch', metavar='FILE', dest='batch', action='store',
+                    help='run the main board once per line of inputs in FILE, - for stdin, printing JSON results')
+parser.add_argument('--batch-range', metavar='START:STOP', dest='batch_range', action='store',
+                    help='run the main board for every combination of inputs from START to STOP-1')
+parser.add_argument('--profile', metavar='FILE', dest='profile', action='store',
+                    help='report calls, memo use, ticks, time and device counts per board on exit, and save them as JSON in FILE')
+parser.add_argument('--trace', metavar='FILE', dest='trace', action='store',
+                    help='write the cells that change on each tick to FILE as lines of JSON, gzipped if it ends in .gz, see render_trace.py')
+parser.add_argument('--trace-every', metavar='N', dest='trace_every', action='store', type=int, default=default_options['trace_every'],
+                    help='only trace every Nth tick of each board, default 1')
+parser.add_argument('--max-ticks', metavar='N', dest='max_ticks', action='store', type=int,
+                    help='stop the run after N more ticks across all boards')
+parser.add_argument('--max-time', metavar='SECONDS', dest='max_time', action='store', type=float,
+                    help='stop the run after SECONDS of wall time')
+parser.add_argument('--max-memory', metavar='MB', dest='max_memory', action='store', type=int,
+                    help='stop the run once the interpreter has used MB megabytes')
+parser.add_argument('--snapshot', metavar='FILE', dest='snapshot', action='store',
+                    help='when the run stops over a budget or is terminated, save its state to FILE to resume from')
+parser.add_argument('--resume', metavar='FILE', dest='resume', action='store',
+                    help='carry on the run saved in snapshot FILE instead of starting one, ignoring the inputs')
+parser.add_argument('--analyze', dest='analyze', action='store_true',
+                    help='print the devices marbles can reach and the ticks each board can take, and exit')
+parser.add_argument('--memo-stats', dest='memo_stats', action='store_true',
+                    help='print memo hits, misses and evictions per board on exit')
 
-options = vars(parser.parse_args())
-
-verbose_stream = sys.stderr if options['stderr'] else sys.stdout
-
+# reads a byte from the descriptor rather than the stream, which is text on
+# python 3.x, as keys typed in UTF-8 are more than one marble
 def unbuffered_getch(stream):
     try:
         import msvcrt # for unbuffered stdin
@@ -50,23 +138,89 @@ def unbuffered_getch(stream):
             try:
                 new_settings[3] = new_settings[3] & ~termios.ICANON # leave canonical mode
                 termios.tcsetattr(fd, termios.TCSANOW, new_settings)
-                ch = stream.read(1)
+                ch = os.read(fd, 1)
             finally:
-                termios.tcsetattr(fd, termios.TCSANOW, old_settings)
+                try:
+                    termios.tcsetattr(fd, termios.TCSANOW, old_settings)
+                except termios.error:
+                    pass  # the terminal has gone, and the read's error says so
         else:
-            ch = stream.read(1)
+            ch = os.read(fd, 1)
     else:
         ch = msvcrt.getch()
     return ch
 
 def enqueue_input(stream, queue):
-    for char in iter(lambda:unbuffered_getch(stream), b''):
-        queue.put(char)
+    try:
+        for char in iter(lambda:unbuffered_getch(stream), b''):
+            queue.put(char)
+    except (IOError, OSError):  # the terminal has gone
+        pass
 
-stdin_queue = Queue()
-stdin_thread = Thread(target=enqueue_input, args=(sys.stdin, stdin_queue))
-stdin_thread.daemon = True # thread dies with the program
-stdin_thread.start()
+# bytes of stdin read at a time from pipes
+input_chunk_size = 65536
+
+def enqueue_chunks(fd, queue):
+    for chunk in iter(lambda:os.read(fd, input_chunk_size), b''):
+        queue.put(chunk)
+
+# bytes waiting for a run's stdin devices, in chunks that a reader thread
+# can add to while get_nowait takes them a byte at a time, raising Empty
+# like Queue when none are waiting
+class Input(object):
+    def __init__(self, data=b''):
+        self.chunks = deque()
+        self.chunk = data
+        self.index = 0
+
+    def put(self, chunk):
+        self.chunks.append(chunk)  # deque appends are thread safe
+
+    def get_nowait(self):
+        while self.index >= len(self.chunk):
+            try:
+                self.chunk = self.chunks.popleft()
+            except IndexError:
+                raise Empty
+            self.index = 0
+        self.index += 1
+        return self.chunk[self.index-1:self.index]
+
+    # the bytes read but not taken yet
+    def pending(self):
+        return b''.join([self.chunk[self.index:]] + list(self.chunks))
+
+    # puts bytes back in front of the ones waiting
+    def unread(self, data):
+        if data:
+            self.chunks.appendleft(self.chunk[self.index:])
+            self.chunk = data
+            self.index = 0
+
+# input from a stream, a terminal is read a key at a time as it's typed, a
+# regular file is mapped in whole and anything else is read in chunks as
+# they arrive
+def open_input(stream):
+    try:
+        fd = stream.fileno()
+        mode = os.fstat(fd).st_mode
+    except (AttributeError, ValueError, OSError):  # not a real file
+        return Input(stream.read())
+    if os.isatty(fd):
+        input = Input()
+        stdin_thread = Thread(target=enqueue_input, args=(stream, input))
+    elif stat.S_ISREG(mode):
+        if os.fstat(fd).st_size == 0:  # can't map an empty file
+            return Input()
+        input = Input(mmap.mmap(fd, 0, access=mmap.ACCESS_READ))
+        input.index = os.lseek(fd, 0, os.SEEK_CUR)  # start where the stream is
+        return input
+    else:
+        input = Input()
+        stdin_thread = Thread(target=enqueue_chunks, args=(fd, input))
+    stdin_thread.daemon = True # thread dies with the program
+    stdin_thread.start()
+    return input
 
 devices = set([
     '  ',
@@ -95,75 +249,278 @@ for p in '=><-+?@&}{':
 for d in oct_digits:
     devices.add('^'+d)
 
+# opcodes for compiled devices, roughly in order of how common they are
+OP_FALL = 0
+OP_RIGHT = 1
+OP_LEFT = 2
+OP_SPLIT = 3
+OP_TRASH = 4
+OP_INCREMENT = 5
+OP_DECREMENT = 6
+OP_SHIFT_LEFT = 7
+OP_SHIFT_RIGHT = 8
+OP_INVERT = 9
+OP_STDIN = 10
+OP_STDOUT = 11
+OP_BIT = 12
+OP_ADD = 13
+OP_SUBTRACT = 14
+OP_EQUAL = 15
+OP_GREATER = 16
+OP_LESS = 17
+OP_RANDOM = 18
+OP_RANDOM_MARBLE = 19
+OP_PORTAL = 20
+OP_SYNC = 21
+OP_OUTPUT = 22
+OP_EXIT = 23
+
+# fixed devices and the opcode they compile to
+device_opcodes = {
+    '..': OP_FALL,
+    '  ': OP_FALL,
+    '\\\\': OP_RIGHT,
+    '//': OP_LEFT,
+    '/\\': OP_SPLIT,
+    '\\/': OP_TRASH,
+    '++': OP_INCREMENT,
+    '--': OP_DECREMENT,
+    '<<': OP_SHIFT_LEFT,
+    '>>': OP_SHIFT_RIGHT,
+    '~~': OP_INVERT,
+    ']]': OP_STDIN,
+    '[[': OP_STDOUT,
+    '??': OP_RANDOM_MARBLE,
+    '{<': OP_OUTPUT,
+    '{>': OP_OUTPUT,
+    '!!': OP_EXIT,
+    }
+# devices with a base 36 constant, by their first character
+constant_opcodes = {
+    '+': OP_ADD,
+    '-': OP_SUBTRACT,
+    '=': OP_EQUAL,
+    '>': OP_GREATER,
+    '<': OP_LESS,
+    '?': OP_RANDOM,
+    '@': OP_PORTAL,
+    '&': OP_SYNC,
+    '{': OP_OUTPUT,
+    '}': OP_FALL,
+    }
+
+# returns the (opcode, operand) pair for one cell of a devices grid
+def compile_device(b):
+    if b is None:  # marble or empty cell
+        return OP_FALL, 0
+    if b in device_opcodes:
+        return device_opcodes[b], 0
+    if len(b) == 2:
+        if b[0] in constant_opcodes and b[1] in b36_digits:
+            return constant_opcodes[b[0]], int(b[1], 36)
+        if b[0] == '^' and b[1] in oct_digits:  # operand is the bit mask
+            return OP_BIT, 1 << int(b[1], 8)
+    return OP_TRASH, 0  # unrecognized devices and function names
+
+# bump when a change to the interpreter invalidates saved memo files or tables
+cache_format = 1
+
+# most ticks one evaluation may take while precomputing a lookup table
+table_tick_limit = 100000
+# most ticks all the evaluations for one table may take together, boards
+# estimated to take more, from their tick bounds or from the evaluations
+# done so far, are left to run as they are
+table_total_tick_limit = 1000000
+
+# most cells with devices a board may have for the jit option to compile it,
+# bigger boards are interpreted rather than written out cell by cell
+jit_cell_limit = 4096
+
+# bump when a change to the interpreter invalidates saved snapshots
+snapshot_format = 1
+
+# ticks between checks of the time and memory budgets
+budget_check_ticks = 1024
+
+# seconds between checks of the budgets and stop requests while waiting on
+# a call a worker process is evaluating
+evaluation_poll = 0.1
+
+# numpy, for the optional vectorized tick, imported by import_numpy only
+# when the backend is asked for since it's slow to import
+np = None
+
+def import_numpy():
+    global np
+    try:
+        import numpy
+    except ImportError:
+        return False
+    np = numpy
+    return True
+
+# fewest marbles on a board before the numpy backend is worth its overhead
+numpy_min_marbles = 64
+
+# devices the numpy backend moves, the rest read stdin, write stdout, roll
+# dice or depend on other cells, so they go through the scalar loop
+vector_opcodes = set([OP_FALL, OP_RIGHT, OP_LEFT, OP_SPLIT, OP_TRASH, OP_INCREMENT,
+                      OP_DECREMENT, OP_SHIFT_LEFT, OP_SHIFT_RIGHT, OP_INVERT, OP_BIT,
+                      OP_ADD, OP_SUBTRACT, OP_EQUAL, OP_GREATER, OP_LESS])
+
+# least recently used cache of sub-board results, keyed by input tuples
+class MemoCache(object):
+    def __init__(self, max_size=0):
+        self.entries = OrderedDict()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.dirty = False
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.entries[key] = value  # reinsert as most recently used
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        self.dirty = True
+        while self.max_size and len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def load(self, filename):
+        if not trusted_file(filename):
+            return
+        try:
+            with open(filename, 'rb') as f:
+                entries = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return
+        for key, value in entries:
+            self.put(key, value)
+        self.dirty = False
+
+    def save(self, filename):
+        # write to a temporary file first so concurrent runs never see half a file
+        fd, temp_filename = tempfile.mkstemp(dir=os.path.dirname(filename))
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(list(self.entries.items()), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_filename, filename)
+        self.dirty = False
+
+# directory for cached programs and precompiled tables unless the cache_dir
+# option gives one, the user's own as they're unpickled
+def user_cache_dir():
+    base_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base_dir, 'marbelous')
+
+# whether a cached pickle can be loaded, which runs whatever code it names,
+# so only if no one but the current user can have written it or its
+# directory
+def trusted_file(filename):
+    if not hasattr(os, 'getuid'):  # no owners to check, on windows
+        return True
+    try:
+        for path in (filename, os.path.dirname(os.path.abspath(filename))):
+            st = os.stat(path)
+            if st.st_uid != os.getuid() or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+                return False
+    except OSError:
+        return False
+    return True
+
+# raised for programs that can't be loaded or run
+class MarbelousError(Exception):
+    pass
+
+# raised when a run stops before finishing, over a budget or because
+# Execution.stop or Program.stop was called, with the snapshot to resume
+# it from
+class Stopped(MarbelousError):
+    def __init__(self, message, snapshot):
+        MarbelousError.__init__(self, message)
+        self.snapshot = snapshot
+
 def format_cell(x):
     return '..' if x is None else hex(x)[2:].upper().zfill(2) if type(x) is int else x.ljust(2)
 
+# trie node that no function device name continues from
+no_names = {}
+
+# Board attributes that come from the source alone, see Program.save_cached
+parsed_fields = ('inputs', 'outputs', 'function_width', 'board_h', 'board_w', 'marbles', 'devices',
+                 'opcodes', 'operands', 'portals', 'synchronizers', 'functions', 'name', 'source',
+                 'has_stdin', 'has_random', 'deterministic')
+
+# pristine definition of a board, shared by every frame that runs it
 class Board:
-    def __init__(self):
+    def __init__(self, program):
+        self.program = program
         # hash of (inputnumber):[(x,y),(x,y)...]
         self.inputs = {}
         self.outputs = {}
         self.function_width = 1
         self.board_h = 0
         self.board_w = 0
-        self.marbles = []
+        # hash of (y,x):value for the marbles placed in the source
+        self.marbles = {}
         self.devices = []
+        # devices compiled by compile_device, one array per row
+        self.opcodes = []
+        self.operands = []
+        # hash of (portal or synchronizer number):[(y,x),(y,x)...]
+        self.portals = {}
+        self.synchronizers = {}
         self.functions = []
-        self.print_out = ''
-        self.recursion_depth = 0
-        self.tick_count = 0
         self.name = ''
-        self.function_queue = deque()
-        self.memoize = {}
-        self.memoizing_inputs = {}
+        self.source = ''
+        self.memoize = MemoCache(program.options['memo_size'])
         self.has_stdin = False
+        self.has_random = False
+        # no stdin or random devices in this board or anything it calls
+        self.deterministic = False
+        # precomputed outputs for every combination of inputs, see tabulate
+        self.table = None
+        self.table_inputs = []
         self.has_stdout = False
-        self.stdout_queue = {}
+        # numpy copies of opcodes and operands, see vector_grids
+        self.vector_cells = None
+        self.vector_opcodes = None
+        self.vector_operands = None
+        # devices formatted for display, one list of cells per row
+        self.display_cells = None
+        # the function transpile compiles the board to, see Frame.tick
+        self.step = None
+        # what analyze works out: the cells marbles can reach, the cells that
+        # can feed each output, the function devices that can be called,
+        # whether a marble can reach stdout and the most ticks the board can
+        # take, None if it might run forever
+        self.reachable = None
+        self.feeds = {}
+        self.callable = []
+        self.writes_stdout = True
+        self.tick_bound = None
 
     def __repr__(self):
-        return "Board name=" + self.name + " tick=" + str(self.tick_count)
-
-    def printr(self, s):
-        verbose_stream.write( (' ' * self.recursion_depth + str(s)) + '\n')
-
-    def write_stdout(self,stdout_str):
-        # print "write_stdout", self
-        if stdout_str:
-            if options['verbose'] > 0:
-                self.print_out += stdout_str
-            if options['verbose'] > 1:
-                self.printr("write_stdout STDOUT: " + ' '.join(["0x" + hex(ord(char))[2:].upper().zfill(2) + \
-                            '/"' + (char if ord(char) > 31 else '?') + '"' for char in stdout_str]))
-            if options['verbose'] == 0 or options['stderr']:
-                sys.stdout.write(stdout_str)
+        return "Board name=" + self.name
 
-    def queue_stdout(self,y,x,char):
-        self.stdout_queue[(y,x)] = char
-
-    def fetch_stdout(self):
-        string = ''
-        for key, char in sorted(self.stdout_queue.items()):
-            string += char
-        self.stdout_queue = {}
-        return string
-
-    def display_tick(self):
-        if self.function_queue:
-            board, coordinates = self.function_queue[0]
-            board.display_tick()
-        else:
-            self.display()
-
-    def display(self):
-        self.printr(':' + self.name + " tick " + str(self.tick_count))
-        for y in range(self.board_h):
-            line = ''
-            for x in range(self.board_w):
-                line += (format_cell(self.marbles[y][x]) if self.marbles[y][x] is not None else format_cell(self.devices[y][x])) + ' '
-            self.printr(line)
-        self.printr('')
+    # what parse and find_functions work out, as saved in the program cache
+    def parsed_state(self):
+        return dict((field, getattr(self, field)) for field in parsed_fields)
 
     def parse(self, input):
+        self.source = ':' + self.name + '\n' + '\n'.join(input)
         board = []
         for line in input:
             line = line.rstrip()
@@ -187,7 +544,7 @@ class Board:
             board.append(row)
             self.board_w = max(self.board_w, len(row))
             self.board_h += 1
-        mbl = [[None for x in range(self.board_w)] for y in range(self.board_h)]
+        mbl = {}
         dev = [[None for x in range(self.board_w)] for y in range(self.board_h)]
         for y in range(self.board_h):
             for x in range(self.board_w):
@@ -198,9 +555,9 @@ class Board:
                 if b is None:
                     continue
                 elif b[0] in hex_digits and b[1] in hex_digits:
-                    mbl[y][x] = int(b, 16)
+                    mbl[(y, x)] = int(b, 16)
                 elif b[0] == "'":
-                    mbl[y][x] = ord(b[1])
+                    mbl[(y, x)] = ord(b[1])
                 else:
                     dev[y][x] = b
                     if b[0] == '}' and b[1] in b36_digits:
@@ -222,402 +579,1954 @@ class Board:
                         self.has_stdin = True
         self.marbles = mbl
         self.devices = dev
+        for row in dev:
+            compiled = [compile_device(b) for b in row]
+            self.opcodes.append(array('b', [op for op, s in compiled]))
+            self.operands.append(array('h', [s for op, s in compiled]))
+        for y in range(self.board_h):
+            for x in range(self.board_w):
+                op = self.opcodes[y][x]
+                if op == OP_PORTAL:
+                    self.portals.setdefault(self.operands[y][x], []).append((y, x))
+                elif op == OP_SYNC:
+                    self.synchronizers.setdefault(self.operands[y][x], []).append((y, x))
+                elif (op == OP_RANDOM and self.operands[y][x]) or op == OP_RANDOM_MARBLE:
+                    self.has_random = True  # ?0 always gives 0
+        # a portal picks randomly when its group has more than one exit
+        if any(len(group) > 2 for group in self.portals.values()):
+            self.has_random = True
         self.function_width = 1
         if len(self.inputs) > 0:
             self.function_width = max(self.function_width, max(self.inputs.keys())+1)
         if len(self.outputs) > 0:
             self.function_width = max(self.function_width, max(self.outputs.keys())+1)
         if self.name != "MB" and (self.function_width*2) % len(self.name) != 0:
-            sys.stderr.write("Board name " + str(self.name) + " not a divisor of width " + str(self.function_width) + '\n')
-            exit(1)
+            raise MarbelousError("Board name " + str(self.name) + " not a divisor of width " + str(self.function_width))
         if self.name != "MB" and len(self.inputs) == 0:
             self.inputs[0] = None
 
-    def find_functions(self):
-        wide_function_names = dict([(b.name * (2 * b.function_width / len(b.name)), b.name) for b in boards.values()])
-        name_so_far = ''
+    # finds the function devices on the board by walking the cells of each
+    # row through the trie from Program.function_trie, taking the first name
+    # that ends on a cell boundary
+    def find_functions(self, trie):
         for y in range(self.board_h):
+            node = None  # None between names
             for x in range(self.board_w):
                 b = self.devices[y][x]
-                if name_so_far == '':
+                if node is None:
                     if b is None or b in devices or (b[0] in hex_digits and b[1] in hex_digits):
                         continue
-                name_so_far += b
-                if name_so_far in wide_function_names:
-                    self.functions.append((y, x-(len(name_so_far)-1)/2, wide_function_names[name_so_far]))
-                    name_so_far = ''
-            if name_so_far != '':
-                sys.stderr.write("Board " + str(self.name) + " row  " + str(y) + " ends with unexpected cells: " + str(name_so_far) + "\n")
-                exit(1)
+                    node = trie
+                    start = x
+                    length = 0
+                for char in b:
+                    node = node.get(char, no_names)
+                length += len(b)
+                if None in node:
+                    self.functions.append((y, x-(length-1)//2, node[None]))
+                    node = None
+            if node is not None:
+                raise MarbelousError("Board " + str(self.name) + " row  " + str(y) + " ends with unexpected cells: " + ''.join(self.devices[y][start:]))
+
+    def dependencies(self):
+        # names of this board and every board it calls, directly or not
+        found = set([self.name])
+        pending = [self]
+        while pending:
+            for y, x, name in pending.pop().functions:
+                if name not in found:
+                    found.add(name)
+                    pending.append(self.program.boards[name])
+        return found
+
+    def signature(self):
+        # results can only be reused by another run if nothing the board
+        # calls reads stdin or rolls dice, and the signature changes with
+        # the source of every board involved
+        if not self.deterministic:
+            return None
+        names = sorted(self.dependencies())
+        digest = hashlib.sha1(str(cache_format).encode())
+        for name in names:
+            digest.update(self.program.boards[name].source.encode())
+        return digest.hexdigest()
+
+    def memo_filename(self):
+        options = self.program.options
+        if not options['memo_dir'] or len(self.inputs) > options['memoize_width']:
+            return None
+        signature = self.signature()
+        if signature is None:
+            return None
+        return os.path.join(options['memo_dir'], signature + '.memo')
+
+    # works out from the devices alone where marbles can go, starting from
+    # the marbles and inputs on the board and adding the outputs of each
+    # function device once all its inputs can be reached
+    def analyze(self):
+        ops = self.opcodes
+        args = self.operands
+        h, w = self.board_h, self.board_w
+
+        def on_board(cell):  # as put in Frame.tick
+            return 0 <= cell[1] < w and 0 < cell[0] < h
+
+        def off_bottom(cell):  # where put sends marbles to stdout
+            return 0 <= cell[1] < w and cell[0] >= h
+
+        # cells a marble on y, x can move to next, itself if it can stay,
+        # including those off the board
+        def moves(y, x):
+            op = ops[y][x]
+            down, right, left = (y+1, x), (y, x+1), (y, x-1)
+            if op in (OP_TRASH, OP_STDOUT, OP_EXIT):
+                cells = []
+            elif op == OP_RIGHT:
+                cells = [right]
+            elif op == OP_LEFT:
+                cells = [left]
+            elif op == OP_SPLIT:
+                cells = [right, left]
+            elif op in (OP_STDIN, OP_EQUAL, OP_GREATER, OP_LESS):
+                cells = [down, right]
+            elif op == OP_PORTAL:
+                cells = [(py+1, px) for py, px in self.portals[args[y][x]] if (py, px) != (y, x)] or [down]
+            elif op == OP_SYNC:
+                cells = [(y, x), down]
+            elif op == OP_OUTPUT:
+                cells = [(y, x)]
+            else:  # falling, and the devices changing marbles on the way down
+                cells = [down]
+            if (y, x) in held:
+                cells.append((y, x))
+            return cells
+
+        functions = [(y, x, self.program.boards[name]) for y, x, name in self.functions]
+        # function device cells keep their marbles until the call is made
+        held = set((y, x+i) for y, x, sub_board in functions for i in range(sub_board.function_width))
+        edges = {}
+        reachable = set(self.marbles)
+        for cells in self.inputs.values():
+            reachable.update(cells or [])
+        pending = list(reachable)
+        callable = []
+        writes_stdout = False
+        while pending:
+            while pending:
+                y, x = pending.pop()
+                cells = moves(y, x)
+                if ops[y][x] == OP_STDOUT or any(off_bottom(cell) for cell in cells):
+                    writes_stdout = True
+                # keeping the outputs of calls found since it was reached
+                edges[(y, x)] = set(cell for cell in cells if on_board(cell)) | edges.get((y, x), set())
+                for cell in edges[(y, x)] - reachable:
+                    reachable.add(cell)
+                    pending.append(cell)
+            for y, x, sub_board in functions:
+                inputs = [(y, x+i) for i in sub_board.inputs]
+                if (y, x, sub_board.name) in callable or not all(cell in reachable for cell in inputs):
+                    continue
+                callable.append((y, x, sub_board.name))
+                outputs = set()
+                for location in sub_board.outputs:
+                    outputs.add((y, x-1) if location == -1 else (y, x+sub_board.function_width) if location == -2 else (y+1, x+location))
+                if any(off_bottom(cell) for cell in outputs):
+                    writes_stdout = True
+                outputs = set(cell for cell in outputs if on_board(cell))
+                # the inputs' marbles come out at the outputs
+                for cell in inputs:
+                    edges[cell] = edges.get(cell, set()) | outputs
+                for cell in outputs - reachable:
+                    reachable.add(cell)
+                    pending.append(cell)
+        self.reachable = reachable
+        self.callable = callable
+        self.writes_stdout = writes_stdout
+
+        # cells that can feed each output, following the edges backwards
+        sources = dict((cell, set()) for cell in edges)
+        for cell, targets in edges.items():
+            for target in targets:
+                sources[target].add(cell)
+        self.feeds = {}
+        for number, cells in self.outputs.items():
+            feeds = set(cell for cell in cells if cell in reachable)
+            pending = list(feeds)
+            while pending:
+                for cell in sources[pending.pop()] - feeds:
+                    feeds.add(cell)
+                    pending.append(cell)
+            self.feeds[number] = feeds
+
+        # with no synchronizers or portals to hold marbles or carry them
+        # back up and no loops between cells, every marble stops or leaves
+        # by the end of the longest path, one tick later it's gone and the
+        # tick after that finds nothing moving
+        self.tick_bound = None
+        if any(ops[y][x] in (OP_SYNC, OP_PORTAL) for y, x in reachable):
+            return
+        incoming = dict((cell, 0) for cell in edges)
+        for cell, targets in edges.items():
+            for target in targets - set([cell]):
+                incoming[target] += 1
+        longest = dict((cell, 0) for cell in edges)
+        pending = [cell for cell, count in incoming.items() if count == 0]
+        done = 0
+        while pending:
+            cell = pending.pop()
+            done += 1
+            for target in edges[cell] - set([cell]):
+                longest[target] = max(longest[target], longest[cell] + 1)
+                incoming[target] -= 1
+                if incoming[target] == 0:
+                    pending.append(target)
+        if done == len(edges):  # no loops
+            self.tick_bound = max(longest.values() or [0]) + 2
+
+    # most ticks a call of the board can take across all the boards it
+    # calls, from analyze's bounds, or None if it has no bound
+    def estimate_ticks(self, calling=()):
+        if self.tick_bound is None or self.name in calling:
+            return None
+        total = self.tick_bound
+        for y, x, name in self.callable:
+            # a call can be made once a tick, and takes a tick to hand back
+            sub_ticks = self.program.boards[name].estimate_ticks(calling + (self.name,))
+            if sub_ticks is None:
+                return None
+            total += self.tick_bound * (sub_ticks + 1)
+        return total
+
+    # compiles the board to a function doing the part of Frame.tick that
+    # moves marbles, step(frame, marbles, next_marbles) returning exit_now
+    # and hidden_activity, with the devices on the board and the cells they
+    # put marbles on written out, and the calls it makes too
+    def transpile(self):
+        ops = self.opcodes
+        args = self.operands
+        h, w = self.board_h, self.board_w
+        names = {'chr': chr, 'Empty': Empty, 'randint': random.randint, 'choice': random.choice}
+
+        def indent(lines):
+            return ['    ' + line for line in lines] or ['    pass']
+
+        # lines that put value on y, x, as put does in Frame.tick
+        def put(y, x, value):
+            if x < 0 or x >= w or y <= 0:
+                return []
+            if y < h:
+                return ['k = (%d, %d)' % (y, x), 'nmb[k] = (nget(k, 0) + %s) %% 256' % value]
+            return ['queue[(%d, %d)] = chr(%s)' % (y, x, value)]
+
+        # each cell with a device that marbles can reach gets a case number,
+        # its marbles fall otherwise
+        cases = {}
+        bodies = [None, ['pass']]  # case 1 is every cell that trashes marbles
+        for y in range(h):
+            for x in range(w):
+                op = ops[y][x]
+                arg = args[y][x]
+                if op == OP_FALL or (y, x) not in self.reachable:
+                    continue
+                elif op == OP_RIGHT:
+                    body = put(y, x+1, 'm')
+                elif op == OP_LEFT:
+                    body = put(y, x-1, 'm')
+                elif op == OP_SPLIT:
+                    body = put(y, x+1, 'm') + put(y, x-1, 'm')
+                elif op == OP_INCREMENT:
+                    body = put(y+1, x, 'm + 1')
+                elif op == OP_DECREMENT:
+                    body = put(y+1, x, 'm - 1')
+                elif op == OP_SHIFT_LEFT:
+                    body = put(y+1, x, '(m << 1)')
+                elif op == OP_SHIFT_RIGHT:
+                    body = put(y+1, x, '(m >> 1)')
+                elif op == OP_INVERT:
+                    body = put(y+1, x, '~m')
+                elif op == OP_STDIN:
+                    body = ['try:', '    char = stdin_get()', 'except Empty:', '    output_flush()'] + \
+                           indent(put(y, x+1, 'm')) + ['else:'] + indent(put(y+1, x, 'ord(char)'))
+                elif op == OP_STDOUT:
+                    body = ['queue[(%d, %d)] = chr(m)' % (y, x)]
+                elif op == OP_BIT:
+                    body = put(y+1, x, '(1 if m & %d else 0)' % arg)
+                elif op == OP_ADD:
+                    body = put(y+1, x, 'm + %d' % arg)
+                elif op == OP_SUBTRACT:
+                    body = put(y+1, x, 'm - %d' % arg)
+                elif op in (OP_EQUAL, OP_GREATER, OP_LESS):
+                    comparison = {OP_EQUAL: '==', OP_GREATER: '>', OP_LESS: '<'}[op]
+                    body = ['if m %s %d:' % (comparison, arg)] + indent(put(y+1, x, 'm')) + ['else:'] + indent(put(y, x+1, 'm'))
+                elif op == OP_RANDOM:
+                    body = ['m = randint(0, %d)' % arg] + put(y+1, x, 'm')
+                elif op == OP_RANDOM_MARBLE:
+                    body = ['m = randint(0, m)'] + put(y+1, x, 'm')
+                elif op == OP_PORTAL:
+                    other_portals = [p for p in self.portals[arg] if p != (y, x)]
+                    if other_portals:
+                        names['portals_%d_%d' % (y, x)] = other_portals
+                        body = ['ny, nx = choice(portals_%d_%d)' % (y, x), 'put(ny+1, nx, m)']
+                    else:
+                        body = put(y+1, x, 'm')
+                elif op == OP_SYNC:
+                    body = ['if synced_%d:' % arg] + indent(put(y+1, x, 'm')) + ['else:'] + indent(put(y, x, 'm'))
+                elif op == OP_OUTPUT:
+                    body = put(y, x, 'm')
+                elif op == OP_EXIT:
+                    body = ['exit_now = True']
+                else:  # trash, and unrecognized devices
+                    cases[(y, x)] = 1
+                    continue
+                cases[(y, x)] = len(bodies)
+                bodies.append(body)
+        if len(cases) > jit_cell_limit:
+            return
+        names['cases_get'] = cases.get
+
+        # finds the case for c in a binary tree of comparisons
+        def dispatch(first, stop):
+            if stop - first <= 3:
+                lines = []
+                for c in range(first, stop):
+                    lines += ['if c == %d:' % c if c == first else 'else:' if c == stop-1 else 'elif c == %d:' % c]
+                    lines += indent(bodies[c])
+                return lines
+            middle = (first + stop) // 2
+            return ['if c < %d:' % middle] + indent(dispatch(first, middle)) + ['else:'] + indent(dispatch(middle, stop))
+
+        lines = ['def step(frame, mbl, nmb, cases_get=cases_get, chr=chr, Empty=Empty, randint=randint, choice=choice):',
+                 '    nget = nmb.get',
+                 '    queue = frame.stdout_queue',
+                 '    exit_now = False',
+                 '    hidden = False']
+        if self.has_stdin:
+            lines += ['    stdin_get = frame.run.stdin.get_nowait',
+                      '    output_flush = frame.run.output.flush']
+        if self.portals or self.functions:
+            lines += ['    call = frame.call',
+                      '    def put(y, x, m):',
+                      '        if x >= 0 and x < %d and y > 0:' % w,
+                      '            if y < %d:' % h,
+                      '                nmb[(y, x)] = (nget((y, x), 0) + m) % 256',
+                      '            else:',
+                      '                frame.queue_stdout(y, x, chr(m))']
+        for s, cells in self.synchronizers.items():
+            lines += ['    synced_%d = %s' % (s, ' and '.join('(%d, %d) in mbl' % cell for cell in cells))]
+        # stdin and random devices take their bytes and numbers in row order
+        ordered = self.has_stdin or self.has_random or self.portals
+        lines += ['    for key, m in %s:' % ('sorted(mbl.items())' if ordered else 'mbl.items()'),
+                  '        c = cases_get(key, 0)',
+                  '        if c == 0:',
+                  '            y, x = key',
+                  '            if y < %d:' % (h - 1),
+                  '                k = (y + 1, x)',
+                  '                nmb[k] = (nget(k, 0) + m) % 256',
+                  '            else:',
+                  '                queue[(y + 1, x)] = chr(m)']
+        if len(bodies) > 1:
+            lines += ['        else:'] + ['            ' + line for line in dispatch(1, len(bodies))]
+
+        for i, (y, x, name) in enumerate(self.functions):
+            sub_board = self.program.boards[name]
+            names['board_%d' % i] = sub_board
+            filled = ' and '.join('(%d, %d) in mbl' % (y, x+j) for j in sub_board.inputs) or 'True'
+            lines += ['    if %s:' % filled,
+                      '        hidden = True',
+                      '        call(%d, %d, board_%d, put)' % (y, x, i),
+                      '    else:']
+            held = []
+            for j in range(sub_board.function_width):
+                held += ['if (%d, %d) in mbl:' % (y, x+j)] + indent(put(y, x+j, 'mbl[(%d, %d)]' % (y, x+j)))
+            lines += ['        ' + line for line in held or ['pass']]
+        lines += ['    return exit_now, hidden']
+
+        exec(compile('\n'.join(lines) + '\n', '<board ' + self.name + '>', 'exec'), names)
+        self.step = names['step']
+
+    # compiles the grids the numpy backend works on, vector_cells marks the
+    # cells it moves, every cell with a vector opcode except the bottom row,
+    # whose marbles fall to stdout
+    def vector_grids(self):
+        if self.vector_cells is None:
+            self.vector_cells = np.array([[y < self.board_h-1 and op in vector_opcodes for op in row]
+                                          for y, row in enumerate(self.opcodes)], dtype=bool).reshape(self.board_h, self.board_w)
+            self.vector_opcodes = np.array([list(row) for row in self.opcodes], dtype=np.int8).reshape(self.board_h, self.board_w)
+            self.vector_operands = np.array([list(row) for row in self.operands], dtype=np.int64).reshape(self.board_h, self.board_w)
+        return self.vector_cells
+
+    def table_index(self, inputs):
+        index = 0
+        for shift, input_num in enumerate(self.table_inputs):
+            index |= inputs[input_num] << (8 * shift)
+        return index
+
+    def tabulate(self):
+        # evaluate the board for every combination of input marbles, giving
+        # up if it or anything it calls can write stdout, or if any of them
+        # runs too long or fails, or the whole table would run too long, as
+        # the program may never give the board those inputs
+        boards = self.program.boards
+        if any(boards[name].writes_stdout for name in self.dependencies()):
+            return None
+        self.table_inputs = sorted(n for n in self.inputs if self.inputs[n] is not None)
+        entries = 256 ** len(self.table_inputs)
+        estimate = self.estimate_ticks()
+        if estimate is not None and estimate * entries > table_total_tick_limit:
+            return None
+        table = []
+        distinct_outputs = {}
+        total_ticks = 0
+        # stdout written here is the analysis missing some, and isn't the
+        # real run's, whose memoizing it would turn off
+        has_stdout = dict((name, b.has_stdout) for name, b in boards.items())
+        run = Run(self.program, stdout=open(os.devnull, 'wb'))
+        try:
+            for index in range(entries):
+                inputs = dict.fromkeys(range(self.function_width))
+                for shift, input_num in enumerate(self.table_inputs):
+                    inputs[input_num] = (index >> (8 * shift)) & 255
+                frame = Frame(self, run)
+                frame.populate_inputs(inputs)
+                try:
+                    ticks = run_frame(frame, table_tick_limit)
+                except Exception:
+                    return None
+                if ticks is None or frame.wrote_stdout:
+                    return None
+                total_ticks += ticks
+                if total_ticks * entries > table_total_tick_limit * (index + 1):
+                    return None
+                outputs = frame.get_output_values()
+                # identical results share one dict to keep big tables small
+                table.append(distinct_outputs.setdefault(tuple(sorted(outputs.items())), outputs))
+        finally:
+            run.stdout.close()
+            for name, b in boards.items():
+                b.has_stdout = has_stdout[name]
+        return table
+
+    def precompile(self, cache_dir):
+        signature = self.signature()
+        if signature is None:
+            return
+        filename = os.path.join(cache_dir, signature + '.table')
+        if trusted_file(filename):
+            try:
+                with open(filename, 'rb') as f:
+                    self.table_inputs, self.table = pickle.load(f)
+                return
+            except (IOError, OSError, EOFError, pickle.UnpicklingError):
+                pass
+        # boards that can't be tabulated are saved too, as a None table, so
+        # later runs don't try again
+        self.table = self.tabulate()
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir, 0o700)
+            fd, temp_filename = tempfile.mkstemp(dir=cache_dir)
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((self.table_inputs, self.table), f, pickle.HIGHEST_PROTOCOL)
+            os.rename(temp_filename, filename)
+        except (IOError, OSError):
+            pass  # the table still works for this run
+
+# one invocation of a board, holding only the state that changes as it runs
+class Frame(object):
+    __slots__ = ('board', 'run', 'marbles', 'next_marbles', 'tick_count', 'function_queue',
+                 'stdout_queue', 'print_out', 'wrote_stdout', 'recursion_depth', 'memoizing_inputs',
+                 'evaluation', 'checkpoint', 'checkpoint_tick', 'profile_start', 'callee_time')
+
+    def __init__(self, board, run, recursion_depth=0):
+        self.board = board
+        self.run = run
+        # hash of (y,x):value for every occupied cell
+        self.marbles = dict(board.marbles)
+        # second marble hash, reused as the next tick's buffer
+        self.next_marbles = {}
+        self.tick_count = 0
+        self.function_queue = deque()
+        self.stdout_queue = {}
+        self.print_out = ''
+        # set once this frame or any function it called wrote to stdout
+        self.wrote_stdout = False
+        self.recursion_depth = recursion_depth
+        self.memoizing_inputs = None
+        # pending result when a worker process runs this frame, see Scheduler
+        self.evaluation = None
+        # state saved for cycle detection, see find_cycle
+        self.checkpoint = None
+        self.checkpoint_tick = 1
+        # total ticks and time when it started, and time spent in calls it
+        # made, when profiling
+        self.profile_start = None
+        self.callee_time = 0.0
+
+    def __repr__(self):
+        return "Frame name=" + self.board.name + " tick=" + str(self.tick_count)
+
+    # what a snapshot keeps of this frame, apart from its board and calls,
+    # copied as the frame changes its dicts in place as it ticks on
+    def state(self):
+        return (dict(self.marbles), self.tick_count, dict(self.stdout_queue), self.print_out, self.wrote_stdout,
+                self.recursion_depth, self.memoizing_inputs)
+
+    # and copied again, so a snapshot can be resumed more than once
+    def restore(self, state):
+        (marbles, self.tick_count, stdout_queue, self.print_out, self.wrote_stdout,
+         self.recursion_depth, self.memoizing_inputs) = state
+        self.marbles, self.stdout_queue = dict(marbles), dict(stdout_queue)
+
+    def printr(self, s):
+        self.run.verbose_stream.write( (' ' * self.recursion_depth + str(s)) + '\n')
+
+    def write_stdout(self,stdout_str):
+        # print "write_stdout", self
+        if stdout_str:
+            options = self.run.options
+            self.wrote_stdout = True
+            self.board.has_stdout = True
+            if options['verbose'] > 0:
+                self.print_out += stdout_str
+            if options['verbose'] > 1:
+                self.printr("write_stdout STDOUT: " + ' '.join(["0x" + hex(ord(char))[2:].upper().zfill(2) + \
+                            '/"' + (char if ord(char) > 31 else '?') + '"' for char in stdout_str]))
+            if options['verbose'] == 0 or options['stderr']:
+                self.run.write(stdout_str)
+
+    def queue_stdout(self,y,x,char):
+        self.stdout_queue[(y,x)] = char
+
+    def fetch_stdout(self):
+        string = ''.join([char for key, char in sorted(self.stdout_queue.items())])
+        self.stdout_queue = {}
+        return string
+
+    def display(self):
+        board = self.board
+        if board.display_cells is None:
+            board.display_cells = [[format_cell(device) + ' ' for device in row] for row in board.devices]
+        # only rows with marbles on differ from the board's own
+        rows = {}
+        for (y, x), m in self.marbles.items():
+            if y not in rows:
+                rows[y] = list(board.display_cells[y])
+            rows[y][x] = format_cell(m) + ' '
+        self.printr(':' + board.name + " tick " + str(self.tick_count))
+        for y in range(board.board_h):
+            self.printr(''.join(rows[y] if y in rows else board.display_cells[y]))
+        self.printr('')
 
     def populate_inputs(self, inputs):
-        if len(self.inputs) <= options['memoize_width'] and not self.has_stdin and not self.has_stdout:
+        board = self.board
+        if len(board.inputs) <= self.run.options['memoize_width'] and not board.has_stdin and not board.has_stdout:
             self.memoizing_inputs = tuple(inputs.items())
-        for input_num,value in inputs.iteritems():
-            if value is not None and self.inputs[input_num] is not None:
-                for y, x in self.inputs[input_num]:
-                    self.marbles[y][x] = value
+        for input_num,value in inputs.items():
+            if value is not None and board.inputs[input_num] is not None:
+                for y, x in board.inputs[input_num]:
+                    self.marbles[(y, x)] = value
 
     def get_output_values(self):
         outputs = {}
-        for output_num, coordinates in self.outputs.items():
+        for output_num, coordinates in self.board.outputs.items():
             for y, x in coordinates:
-                if self.marbles[y][x] is not None:
+                if (y, x) in self.marbles:
                     if output_num not in outputs:
-                        outputs[output_num] = self.marbles[y][x]
+                        outputs[output_num] = self.marbles[(y, x)]
                     else:
-                        outputs[output_num] += self.marbles[y][x]
+                        outputs[output_num] += self.marbles[(y, x)]
         return outputs
 
     def all_outputs_filled(self):
-        if not self.outputs:
+        if not self.board.outputs:
             return False
-        for output_set in self.outputs.values():
+        for output_set in self.board.outputs.values():
             output_filled = False
             for y, x in output_set:
-                if self.marbles[y][x] is not None:
+                if (y, x) in self.marbles:
                     output_filled = True
                     break
             if not output_filled:
                 return False
         return True
 
-    def tick(self):
+    # collects the outputs of the finished call at the head of the function queue
+    def finish_call(self):
+        board = self.board
+        options = self.run.options
         mbl = self.marbles
         def put_immediate(y, x, m):
-            if x >= 0 and x<self.board_w and y>0:
-                if y<self.board_h:
-                    mbl[y][x] = (m % 256) if not mbl[y][x] else (mbl[y][x]+m) % 256
+            if x >= 0 and x<board.board_w and y>0:
+                if y<board.board_h:
+                    mbl[(y, x)] = (mbl.get((y, x), 0) + m) % 256
                 else:
                     self.queue_stdout(y,x,chr(m))
-        if self.function_queue:
-            board, coordinates = self.function_queue[0]
-            y, x = coordinates
-            if not board.tick():
-                outputs = board.get_output_values()
-                if len(board.inputs) <= options['memoize_width'] and not board.has_stdin and not board.has_stdout:
-                    boards[board.name].memoize[board.memoizing_inputs] = (outputs,board.fetch_stdout())
-                for location, value in outputs.items():
-                    if location == -1:
-                        put_immediate(y, x-1, value)
-                    elif location == -2:
-                        put_immediate(y, x+board.function_width, value)
-                    else:
-                        put_immediate(y+1, x+int(location), value)
-                self.function_queue.popleft()
-                self.stdout_queue[(y,x)] = board.print_out
-                if options['verbose'] > 2:
-                    board.display()
-            return True
+        frame, coordinates = self.function_queue.popleft()
+        sub_board = frame.board
+        y, x = coordinates
+        outputs = frame.get_output_values()
+        if len(sub_board.inputs) <= options['memoize_width'] and not sub_board.has_stdin and not sub_board.has_stdout:
+            sub_board.memoize.put(frame.memoizing_inputs, (outputs,frame.fetch_stdout()))
+        for location, value in outputs.items():
+            if location == -1:
+                put_immediate(y, x-1, value)
+            elif location == -2:
+                put_immediate(y, x+sub_board.function_width, value)
+            else:
+                put_immediate(y+1, x+int(location), value)
+        if frame.wrote_stdout:
+            self.stdout_queue[(y,x)] = frame.print_out
+            self.wrote_stdout = True
+            board.has_stdout = True
+        if options['verbose'] > 2:
+            frame.display()
 
+    # advances a frame with no pending function calls by one tick, returns
+    # False once the board has finished
+    def tick(self):
+        board = self.board
+        options = self.run.options
+        mbl = self.marbles
         if self.stdout_queue:
             self.write_stdout(self.fetch_stdout())
-            boards[self.name].has_stdout = True
 
         if self.all_outputs_filled():
             if options['verbose'] > 1:
-                self.printr("Exiting board " + str(self.name) + " on tick " + str(self.tick_count) + " due to filled { devices")
+                self.printr("Exiting board " + str(board.name) + " on tick " + str(self.tick_count) + " due to filled { devices")
             return False
 
         self.tick_count += 1
-        dev = self.devices
-        # new marble array
-        nmb = [[None for x in range(self.board_w)] for y in range(self.board_h)]
+        ops = board.opcodes
+        args = board.operands
+        # reuse the spare marble hash for the next tick
+        nmb = self.next_marbles
+        nmb.clear()
         exit_now = False
         hidden_activity = False
 
+        if board.step is not None:
+            exit_now, hidden_activity = board.step(self, mbl, nmb)
+            return self.end_tick(exit_now, hidden_activity)
+
         def put(y, x, m):
-            if x >= 0 and x<self.board_w and y>0:
-                if y<self.board_h:
-                    nmb[y][x] = (m % 256) if not nmb[y][x] else (nmb[y][x]+m) % 256
+            if x >= 0 and x<board.board_w and y>0:
+                if y<board.board_h:
+                    nmb[(y, x)] = (nmb.get((y, x), 0) + m) % 256
                 else:
                     self.queue_stdout(y,x,chr(m))
 
-        # process each marble
-        for y in range(self.board_h):
-            for x in range(self.board_w):
-                m = mbl[y][x]
-                i = dev[y][x]
-                l = 0  # move left?
-                r = 0  # move right?
-                d = 0  # move down?
-                new_x = None
-                new_y = None
-                if m is None:  # no marble
-                    continue
-                elif i:  # device
-                    if i == '..' or i == '  ':  # fall
-                        d = 1
-                    elif i == '\\\\':  # divert right
-                        r = 1
-                    elif i == '//':  # divert left
-                        l = 1
-                    elif i == '/\\':  # split
-                        r = 1
-                        l = 1
-                    elif i == '\\/':  # trash
-                        pass
-                    elif i == '++':  # increment
-                        d = 1
-                        m += 1
-                    elif i == '--':  # decrement
-                        d = 1
-                        m -= 1
-                    elif i == '<<': # shift left
-                        d = 1
-                        m = m << 1
-                    elif i == '>>': # shift right
-                        d = 1
-                        m = m >> 1
-                    elif i == '~~': # invert bits / logical not
-                        d = 1
-                        m = ~m
-                    elif i == ']]': # fetch from stdin
-                        try:
-                            char = stdin_queue.get_nowait()
-                        except Empty: # no bytes pending from stdin, divert right
-                            r = 1
-                        else: # got a byte from stdin, drop that byte as a marble
-                            m = ord(char)
-                            d = 1
-                    elif i == '[[': # send to stdout
-                        #FIXME this shouldn't happen until after queued subboards process
-                        self.queue_stdout(y,x,chr(m))
-                    elif i[0] == '^' and i[1] in oct_digits:  # fetch a bit
-                        s = int(i[1], 8)
-                        d = 1
-                        m = (m & (1 << s)) > 0
-                    elif i[0] == '+' and i[1] in b36_digits:  # add a constant
-                        s = int(i[1], 36)
-                        d = 1
-                        m = m + s
-                    elif i[0] == '-' and i[1] in b36_digits:  # subtract a constant
-                        s = int(i[1], 36)
-                        d = 1
-                        m = m - s
-                    elif i[0] == '=' and i[1] in b36_digits:  # equals a constant?
-                        s = int(i[1], 36)
-                        if m == s:
-                            d = 1
-                        else:
-                            r = 1
-                    elif i[0] == '>' and i[1] in b36_digits:  # greater than a constant?
-                        s = int(i[1], 36)
-                        if m > s:
-                            d = 1
-                        else:
-                            r = 1
-                    elif i[0] == '<' and i[1] in b36_digits:  # less than a constant?
-                        s = int(i[1], 36)
-                        if m < s:
-                            d = 1
-                        else:
-                            r = 1
-                    elif i[0] == '?' and (i[1] in b36_digits or i[1] == '?'):  # random number, 0-static or 0-marble
-                        if i[1] != '?':
-                            s = int(i[1], 36)
-                        else:
-                            s = m
-                        m = random.randint(0, s)
-                        d = 1
-                    elif i[0] == '@' and i[1] in b36_digits:  # portal
-                        s = int(i[1], 36)
-                        other_portals = []
-                        for k in range(self.board_h):
-                            for j in range(self.board_w):
-                                if (k != y or j != x) and \
-                                    dev[k][j] and \
-                                    dev[k][j][0] == '@' and \
-                                    dev[k][j][1] == i[1]:
-                                    other_portals.append((k, j))
-                        if other_portals:
-                            new_y, new_x = random.choice(other_portals)
-                            d = 1
-                        else:
-                            d = 1
-                    elif i[0] == '&' and i[1] in b36_digits:  # synchronize
-                        if m is not None:
-                            s = int(i[1], 36)
-                            release = True
-                            for k in range(self.board_h):
-                                for j in range(self.board_w):
-                                    if (k != y or j != x) and \
-                                        dev[k][j] and \
-                                        dev[k][j][0] == '&' and \
-                                        dev[k][j][1] == i[1] and \
-                                        mbl[k][j] is None:
-                                        release = False
-                            if release is False:
-                                put(y, x, m)
-                            else:
-                                d = 1
-                    elif i[0] == '{' and (i[1] in b36_digits or i[1] == '<' or i[1] == '>'):  # output
-                        put(y, x, m)
-                    elif i[0] == '}' and i[1] in b36_digits:  # input == fall
-                        d = 1
-                    elif i == '!!':  # exit
-                        exit_now = True
-                    else:  # unrecognized device
-                        pass  # default to trash!
-                else:  # no device
+        # count the occupied synchronizers in each group
+        synced = dict.fromkeys(board.synchronizers, 0)
+        if synced:
+            for y, x in mbl:
+                if ops[y][x] == OP_SYNC:
+                    synced[args[y][x]] += 1
+
+        if options['numpy'] and len(mbl) >= numpy_min_marbles:
+            cells = self.vector_tick(nmb)
+        else:
+            cells = sorted(mbl.items())
+
+        # process each occupied cell, in row order so stdin and random
+        # devices see marbles in the same order as a full board scan
+        for (y, x), m in cells:
+            op = ops[y][x]
+            l = 0  # move left?
+            r = 0  # move right?
+            d = 0  # move down?
+            new_x = None
+            new_y = None
+            if op == OP_FALL:  # empty cell, marble, input or fall device
+                d = 1
+            elif op == OP_RIGHT:  # divert right
+                r = 1
+            elif op == OP_LEFT:  # divert left
+                l = 1
+            elif op == OP_SPLIT:  # split
+                r = 1
+                l = 1
+            elif op == OP_TRASH:  # trash, and unrecognized devices
+                pass
+            elif op == OP_INCREMENT:  # increment
+                d = 1
+                m += 1
+            elif op == OP_DECREMENT:  # decrement
+                d = 1
+                m -= 1
+            elif op == OP_SHIFT_LEFT: # shift left
+                d = 1
+                m = m << 1
+            elif op == OP_SHIFT_RIGHT: # shift right
+                d = 1
+                m = m >> 1
+            elif op == OP_INVERT: # invert bits / logical not
+                d = 1
+                m = ~m
+            elif op == OP_STDIN: # fetch from stdin
+                try:
+                    char = self.run.stdin.get_nowait()
+                except Empty: # no bytes pending from stdin, divert right
+                    self.run.output.flush() # show any prompt before waiting, like C stdio
+                    r = 1
+                else: # got a byte from stdin, drop that byte as a marble
+                    m = ord(char)
+                    d = 1
+            elif op == OP_STDOUT: # send to stdout
+                #FIXME this shouldn't happen until after queued subboards process
+                self.queue_stdout(y,x,chr(m))
+            elif op == OP_BIT:  # fetch a bit
+                d = 1
+                m = 1 if m & args[y][x] else 0
+            elif op == OP_ADD:  # add a constant
+                d = 1
+                m = m + args[y][x]
+            elif op == OP_SUBTRACT:  # subtract a constant
+                d = 1
+                m = m - args[y][x]
+            elif op == OP_EQUAL:  # equals a constant?
+                if m == args[y][x]:
+                    d = 1
+                else:
+                    r = 1
+            elif op == OP_GREATER:  # greater than a constant?
+                if m > args[y][x]:
+                    d = 1
+                else:
+                    r = 1
+            elif op == OP_LESS:  # less than a constant?
+                if m < args[y][x]:
+                    d = 1
+                else:
+                    r = 1
+            elif op == OP_RANDOM:  # random number, 0-static
+                m = random.randint(0, args[y][x])
+                d = 1
+            elif op == OP_RANDOM_MARBLE:  # random number, 0-marble
+                m = random.randint(0, m)
+                d = 1
+            elif op == OP_PORTAL:  # portal
+                other_portals = [p for p in board.portals[args[y][x]] if p != (y, x)]
+                if other_portals:
+                    new_y, new_x = random.choice(other_portals)
+                d = 1
+            elif op == OP_SYNC:  # synchronize
+                s = args[y][x]
+                if synced[s] < len(board.synchronizers[s]):
+                    put(y, x, m)
+                else:  # every synchronizer in the group holds a marble
                     d = 1
-                new_y = new_y if new_y is not None else y
-                new_x = new_x if new_x is not None else x
-                if d:
-                    put(new_y+1, new_x, m)
-                if r:
-                    put(new_y, new_x+1, m)
-                if l:
-                    put(new_y, new_x-1, m)
-
-        for y, x, name in self.functions:
+            elif op == OP_OUTPUT:  # output
+                put(y, x, m)
+            elif op == OP_EXIT:  # exit
+                exit_now = True
+            new_y = new_y if new_y is not None else y
+            new_x = new_x if new_x is not None else x
+            if d:
+                put(new_y+1, new_x, m)
+            if r:
+                put(new_y, new_x+1, m)
+            if l:
+                put(new_y, new_x-1, m)
+
+        for y, x, name in board.functions:
             run = True
-            sub_board = boards[name]
+            sub_board = self.run.program.boards[name]
             for i in sub_board.inputs:
-                if self.marbles[y][x+i] is None:
+                if (y, x+i) not in mbl:
                     run = False
                     break
             if run:
                 hidden_activity = True
-                inputs = {}
-                for i in range(sub_board.function_width):
-                    inputs[i] = self.marbles[y][x+i]
-                if len(sub_board.inputs) <= options['memoize_width'] and tuple(inputs.items()) in sub_board.memoize and not sub_board.has_stdin and not sub_board.has_stdout:
-                    outputs = sub_board.memoize[tuple(inputs.items())][0]
-                    for location, value in outputs.items():
-                        if location == -1:
-                            put(y, x-1, value)
-                        elif location == -2:
-                            put(y, x+sub_board.function_width, value)
-                        else:
-                            put(y+1, x+int(location), value)
-                    self.write_stdout(self.fetch_stdout())
-                else:
-                    self.function_queue.append((copy.deepcopy(sub_board), (y, x)))
-                    self.function_queue[-1][0].populate_inputs(inputs)
-                    self.function_queue[-1][0].recursion_depth = self.recursion_depth+1
+                self.call(y, x, sub_board, put)
             else:
                 for i in range(sub_board.function_width):
-                    if self.marbles[y][x+i] is not None:
-                        put(y, x+i, self.marbles[y][x+i])
+                    if (y, x+i) in mbl:
+                        put(y, x+i, mbl[(y, x+i)])
 
-        diff = sum([cmp(x, y) != 0 for x, y in zip(self.marbles, nmb)])
-        if diff == 0 and hidden_activity is False:
+        return self.end_tick(exit_now, hidden_activity)
+
+    # calls the function device at y, x whose inputs are all filled, from a
+    # table or memo if it can, else queueing a frame to run it
+    def call(self, y, x, sub_board, put):
+        mbl = self.marbles
+        inputs = {}
+        for i in range(sub_board.function_width):
+            inputs[i] = mbl.get((y, x+i))
+        memoized = None
+        call = 'unmemoized'
+        if sub_board.table is not None:
+            memoized = (sub_board.table[sub_board.table_index(inputs)],)
+            call = 'table_hits'
+        elif len(sub_board.inputs) <= self.run.options['memoize_width'] and not sub_board.has_stdin and not sub_board.has_stdout:
+            memoized = sub_board.memoize.get(tuple(inputs.items()))
+            call = 'memo_misses' if memoized is None else 'memo_hits'
+        if self.run.profile is not None:
+            self.run.profile.count_call(sub_board.name, call)
+        if memoized is not None:
+            outputs = memoized[0]
+            for location, value in outputs.items():
+                if location == -1:
+                    put(y, x-1, value)
+                elif location == -2:
+                    put(y, x+sub_board.function_width, value)
+                else:
+                    put(y+1, x+int(location), value)
+        else:
+            frame = Frame(sub_board, self.run, self.recursion_depth+1)
+            frame.populate_inputs(inputs)
+            self.function_queue.append((frame, (y, x)))
+
+    # ends a tick whose marbles have moved into next_marbles, returning
+    # False if that finished the board
+    def end_tick(self, exit_now, hidden_activity):
+        board = self.board
+        options = self.run.options
+        mbl = self.marbles
+        nmb = self.next_marbles
+        # only occupied cells are compared, so this is O(marbles) not O(area)
+        if nmb == mbl and hidden_activity is False:
             if options['verbose'] > 1:
-                self.printr("Exiting board " + str(self.name) + " on tick " + str(self.tick_count) + " due to lack of activity")
+                self.printr("Exiting board " + str(board.name) + " on tick " + str(self.tick_count) + " due to lack of activity")
             return False
         if exit_now:
             if options['verbose'] > 1:
-                self.printr("Exiting board " + str(self.name) + " on tick " + str(self.tick_count) + " due to filled X devices")
+                self.printr("Exiting board " + str(board.name) + " on tick " + str(self.tick_count) + " due to filled X devices")
             return False
-        self.marbles = nmb
+        # swap buffers, the old marble hash is cleared and reused next tick
+        self.marbles, self.next_marbles = nmb, mbl
         return True
 
-# the boards array contains pristine instances of boards from the source
-boards = {}
-files_included = set()
+    # moves the marbles on simple devices into nmb with whole-array
+    # operations, returning the rest in row order for the scalar loop in tick
+    def vector_tick(self, nmb):
+        board = self.board
+        mbl = self.marbles
+        vector_cells = board.vector_grids()
+        try:
+            m = np.fromiter(mbl.values(), dtype=np.int64, count=len(mbl))
+        except OverflowError: # marbles too big for int64, from huge inputs
+            return sorted(mbl.items())
+        ys, xs = np.fromiter(itertools.chain.from_iterable(mbl), dtype=np.int64, count=2*len(mbl)).reshape(-1, 2).T
+        vector = vector_cells[ys, xs]
+        cells = sorted((key, mbl[key]) for key in zip(ys[~vector].tolist(), xs[~vector].tolist()))
+        ys, xs, m = ys[vector], xs[vector], m[vector]
+        op = board.vector_opcodes[ys, xs]
+        arg = board.vector_operands[ys, xs]
 
-def load_mbl_file(filename,ignore_main=True):
-    lines = []
-    if filename not in files_included:
-        files_included.add(filename)
-        main_skipped = False
+        # comparisons pass matching marbles down and the rest to the right
+        compared = (op == OP_EQUAL) | (op == OP_GREATER) | (op == OP_LESS)
+        passed = ((op == OP_EQUAL) & (m == arg)) | ((op == OP_GREATER) & (m > arg)) | ((op == OP_LESS) & (m < arg))
+        down = np.isin(op, [OP_FALL, OP_INCREMENT, OP_DECREMENT, OP_SHIFT_LEFT, OP_SHIFT_RIGHT,
+                            OP_INVERT, OP_BIT, OP_ADD, OP_SUBTRACT]) | passed
+        right = (op == OP_RIGHT) | (op == OP_SPLIT) | (compared & ~passed)
+        left = (op == OP_LEFT) | (op == OP_SPLIT)
+        m = np.select([op == OP_INCREMENT, op == OP_DECREMENT, op == OP_SHIFT_LEFT, op == OP_SHIFT_RIGHT,
+                       op == OP_INVERT, op == OP_BIT, op == OP_ADD, op == OP_SUBTRACT],
+                      [m + 1, m - 1, m << 1, m >> 1, ~m, ((m & arg) != 0).astype(np.int64), m + arg, m - arg],
+                      default=m)
+
+        # same rules as put in tick, nothing lands on the top row or off the
+        # sides, and marbles never fall off the bottom from these cells
+        right &= (ys > 0) & (xs + 1 < board.board_w)
+        left &= (ys > 0) & (xs > 0)
+        w = board.board_w
+        index = np.concatenate([(ys[down] + 1) * w + xs[down], ys[right] * w + xs[right] + 1, ys[left] * w + xs[left] - 1])
+        values = np.concatenate([m[down], m[right], m[left]])
+        # marbles landing on the same cell add up, modulo 256 like put
+        totals = np.zeros(board.board_h * w, dtype=np.int64)
+        np.add.at(totals, index, values)
+        occupied = np.unique(index)
+        nmb.update(zip(zip(*[a.tolist() for a in np.divmod(occupied, w)]), (totals[occupied] % 256).tolist()))
+        return cells
+
+    # takes the final state of a frame that a worker process ran to
+    # completion, returning the ticks it took there, or returns None and
+    # leaves the frame to tick here if it ran out of the ticks it was given,
+    # for the run's tick budget to stop it
+    def collect_evaluation(self):
+        evaluation = self.evaluation.get()
+        self.evaluation = None
+        if evaluation is None:
+            return None
+        self.marbles, self.stdout_queue, stdout_str, wrote_stdout, ticks = evaluation
+        if wrote_stdout:
+            self.wrote_stdout = True
+            self.board.has_stdout = True
+            self.run.write(stdout_str)
+        return ticks
+
+    # compares the state about to tick with the one saved at the last power
+    # of two tick, as in Brent's algorithm, returning the ticks since then if
+    # they match, in which case a deterministic frame is going round forever
+    def find_cycle(self):
+        checkpoint = self.checkpoint
+        if checkpoint is not None and checkpoint[0] == self.marbles and checkpoint[1] == self.stdout_queue:
+            return self.tick_count - checkpoint[2]
+        if self.tick_count == self.checkpoint_tick:
+            self.checkpoint = (dict(self.marbles), dict(self.stdout_queue), self.tick_count)
+            self.checkpoint_tick *= 2
+        return None
+
+# stdout of a run, collected in a bytearray and written to the stream once
+# flush_size bytes are waiting, at every newline too with the line policy,
+# and whatever is left when the run ends
+class Output(object):
+    def __init__(self, stream, policy=None):
+        self.stream = stream
+        if policy is None:
+            policy = 'line' if hasattr(stream, 'isatty') and stream.isatty() else 'size'
+        self.policy = policy
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer.extend(data)
+        if self.policy == 'exit':
+            return
+        if len(self.buffer) >= flush_size or (self.policy == 'line' and b'\n' in data):
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            stream = self.stream
+            if hasattr(stream, 'buffer'):  # python 3.x text stream
+                stream.flush()
+                stream = stream.buffer
+            stream.write(bytes(self.buffer))
+            stream.flush()
+            del self.buffer[:]
+
+# state for one run of a program, where its stdin devices read from and its
+# stdout devices write to
+class Run(object):
+    def __init__(self, program, stdin=None, stdout=None, flush=None, profile=None, trace=None):
+        self.program = program
+        self.profile = profile
+        self.trace = trace
+        self.options = program.options
+        self.stdin = Input() if stdin is None else stdin
+        self.stdout = sys.stdout if stdout is None else stdout
+        self.output = Output(self.stdout, flush or self.options['flush'])
+        self.verbose_stream = sys.stderr if self.options['stderr'] else sys.stdout
+        # list collecting what's written to stdout while a cycle is measured
+        self.recording = None
+
+    def write(self, stdout_str):
+        if not isinstance(stdout_str, bytes):  # python 3.x str from chr
+            stdout_str = stdout_str.encode('latin-1')
+        self.output.write(stdout_str)
+        if self.recording is not None:
+            self.recording.append(stdout_str)
+
+# the program worker processes evaluate calls for, set as they start
+worker_program = None
+
+def init_worker(program):
+    global worker_program
+    worker_program = program
+    program.options['jobs'] = 1  # a worker evaluates its share itself
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)  # Pool.terminate stops workers with SIGTERM
+
+# runs a function call to completion in a worker process, capturing what it
+# writes to stdout so the caller can write it in order, or returns None if
+# it's still running after max_ticks
+def evaluate_call(name, marbles, max_ticks=None):
+    run = Run(worker_program, stdout=BytesIO(), flush='exit')
+    frame = Frame(worker_program.boards[name], run)
+    frame.marbles = marbles
+    ticks = run_frame(frame, max_ticks)
+    if ticks is None:
+        return None
+    run.output.flush()
+    # less the one run_frame counts to start, as the caller counts its own
+    return frame.marbles, frame.stdout_queue, run.stdout.getvalue(), frame.wrote_stdout, ticks - 1
+
+# runs a frame and the function calls it makes using an explicit stack of
+# frames instead of recursion, each frame in the stack being the call at
+# the head of the previous frame's function queue
+class Scheduler(object):
+    def __init__(self, frame, pool=None, max_ticks=None):
+        self.stack = [frame]
+        self.pool = pool
+        self.max_ticks = max_ticks
+        # set when the last step waited on a worker process instead of ticking
+        self.waiting = False
+        # total ticks across all boards, counting the one to start
+        self.ticks = 1
+        # frame going round a cycle, its tick count when the lap being
+        # recorded ends and the total ticks when it started
+        self.cycle = None
+        # (run, period, output) of the cycle whose laps are being skipped,
+        # see fast_forward
+        self.replay = None
+        # frame traces and --trace files would show the skipped ticks
+        self.watch_cycles = frame.run.options['verbose'] == 0 and frame.run.trace is None
+        self.profile = frame.run.profile
+        # frames of each board running, for --profile to add only the
+        # outermost of a board's recursive calls to its totals
+        self.profile_depths = {}
+        if self.profile is not None:
+            self.profile_frame(frame)
+        self.trace = frame.run.trace
+        if self.trace is not None:
+            self.trace.start(frame, self.ticks)
+
+    # the frame that ticks next, the innermost pending call
+    def active_frame(self):
+        frame = self.stack[-1]
+        while frame.function_queue:
+            if self.pool is not None:
+                self.dispatch(frame.function_queue)
+            frame = frame.function_queue[0][0]
+            self.stack.append(frame)
+            if self.profile is not None:
+                self.profile_frame(frame)
+            if self.trace is not None:
+                self.trace.start(frame, self.ticks)
+        return frame
+
+    # notes a frame starting, for --profile
+    def profile_frame(self, frame):
+        frame.profile_start = (self.ticks, time.time())
+        name = frame.board.name
+        self.profile_depths[name] = self.profile_depths.get(name, 0) + 1
+
+    # hands the deterministic calls waiting in a function queue to the pool
+    # all at once, their results are collected in queue order by step
+    def dispatch(self, function_queue):
+        calls = [frame for frame, coordinates in function_queue
+                 if frame.evaluation is None and frame.board.deterministic]
+        if len(calls) > 1:
+            # each call may take what's left of the run's tick budget
+            max_ticks = None if self.max_ticks is None else max(0, self.max_ticks - self.ticks)
+            for frame in calls:
+                frame.evaluation = self.pool.apply_async(evaluate_call, (frame.board.name, frame.marbles, max_ticks))
+
+    # whether a worker process is still evaluating a call of the run
+    def evaluating(self):
+        return any(frame.evaluation is not None and not frame.evaluation.ready()
+                   for caller in self.stack for frame, coordinates in caller.function_queue)
+
+    # ticks the active frame, or hands a finished call back to its caller,
+    # returns False once the outermost frame has finished
+    def step(self):
+        frame = self.active_frame()
+        self.waiting = False
+        if frame.evaluation is not None and not frame.evaluation.ready():
+            # returns to let Execution.advance check the budgets meanwhile
+            frame.evaluation.wait(evaluation_poll)
+            self.waiting = True
+            return True
+        evaluated_ticks = None if frame.evaluation is None else frame.collect_evaluation()
+        if evaluated_ticks is not None:
+            self.ticks += evaluated_ticks
+        else:
+            # a board with a tick bound can't cycle
+            if self.watch_cycles and frame.board.deterministic and frame.board.tick_bound is None and self.replay is None:
+                self.watch(frame)
+            if self.replay is not None and self.skip_laps():
+                return True
+            if self.profile is not None:
+                self.profile.count_tick(frame)
+            if frame.tick():
+                self.ticks += 1
+                if self.trace is not None:
+                    self.trace.tick(frame, self.ticks)
+                return True
+        if self.profile is not None:
+            name = frame.board.name
+            self.profile_depths[name] -= 1
+            self.profile.count_finish(frame, self.ticks, self.stack[-2] if len(self.stack) > 1 else None, self.profile_depths[name] == 0)
+        if self.trace is not None:
+            self.trace.finish(frame, self.ticks)
+        if len(self.stack) == 1:
+            return False
+        self.stack.pop()
+        self.stack[-1].finish_call()
+        self.ticks += 1
+        if self.trace is not None:  # the call's outputs are on the caller's board
+            self.trace.tick(self.stack[-1], self.ticks)
+        return True
+
+    # looks for a cycle in a frame about to tick, and once one is found
+    # records a lap of it to replay in fast_forward, the lap after the one
+    # found since memoized calls can make later laps take fewer ticks
+    def watch(self, frame):
+        if self.cycle is None:
+            period = frame.find_cycle()
+            if period:
+                self.cycle = (frame, frame.tick_count + period, self.ticks)
+                frame.run.recording = []
+        elif self.cycle[0] is frame and frame.tick_count == self.cycle[1]:
+            run = frame.run
+            output = b''.join(run.recording)
+            run.recording = None
+            self.fast_forward(run, self.ticks - self.cycle[2], output)
+            self.cycle = None
+
+    # skips the laps of a cycle from here on instead of ticking them, the
+    # frame can never finish so without max_ticks that's the rest of the run
+    def fast_forward(self, run, period, output):
+        self.replay = (run, period, output)
+
+    # writes what a step's worth of skipped laps would have, a chunk of
+    # output or enough laps to reach the next budget check, so Execution
+    # still checks its budgets and stop requests between steps, returning
+    # False once the laps left don't fit in max_ticks and have to be ticked
+    def skip_laps(self):
+        run, period, output = self.replay
+        laps = max(1, 65536 // len(output)) if output else max(1, budget_check_ticks // period)
+        if self.max_ticks is not None:
+            # the step after the laps ticks once more
+            laps = min(laps, (self.max_ticks - self.ticks - 1) // period)
+            if laps <= 0:
+                self.replay = None
+                return False
+        elif not output:
+            time.sleep(0.1)  # nothing to do until the run is stopped
+        run.write(output * laps)
+        self.ticks += laps * period
+        return True
+
+    def display(self):
+        self.active_frame().display()
+
+# what --profile collects for each board: how it was called, the ticks
+# and seconds spent in it alone and with the calls it made, and how often
+# marbles went through each device and each cell
+class Profile(object):
+    def __init__(self):
+        self.boards = {}
+
+    def board(self, name):
+        stats = self.boards.get(name)
+        if stats is None:
+            stats = self.boards[name] = {
+                'calls': 0,
+                'table_hits': 0,
+                'memo_hits': 0,
+                'memo_misses': 0,
+                'unmemoized': 0,
+                'self_ticks': 0,
+                'total_ticks': 0,
+                'self_time': 0.0,
+                'total_time': 0.0,
+                'devices': {},
+                'cells': {},
+                }
+        return stats
+
+    # call is how the call was answered, table_hits, memo_hits,
+    # memo_misses or unmemoized
+    def count_call(self, name, call):
+        stats = self.board(name)
+        stats['calls'] += 1
+        stats[call] += 1
+
+    # counts the marbles a frame is about to move
+    def count_tick(self, frame):
+        board = frame.board
+        stats = self.board(board.name)
+        stats['self_ticks'] += 1
+        devices = stats['devices']
+        cells = stats['cells']
+        for y, x in frame.marbles:
+            device = format_cell(board.devices[y][x])
+            devices[device] = devices.get(device, 0) + 1
+            cells[(y, x)] = cells.get((y, x), 0) + 1
+
+    # outermost is whether no other frame of the board is running, as the
+    # totals of recursive calls are already in the outermost one's, as in
+    # cProfile's cumulative time
+    def count_finish(self, frame, ticks, caller, outermost=True):
+        start_ticks, start_time = frame.profile_start
+        elapsed = time.time() - start_time
+        stats = self.board(frame.board.name)
+        if outermost:
+            stats['total_ticks'] += ticks - start_ticks + 1  # and the tick that finished it
+            stats['total_time'] += elapsed
+        stats['self_time'] += elapsed - frame.callee_time
+        if caller is not None:
+            caller.callee_time += elapsed
+
+    # writes a table of the boards, the ones taking the most time alone first
+    def report(self, stream):
+        columns = ('calls', 'table_hits', 'memo_hits', 'memo_misses', 'unmemoized', 'self_ticks', 'total_ticks')
+        widths = [max(9, len(c)) for c in columns]
+        stream.write("%-16s" % 'board' + ''.join(" %*s" % (w, c) for w, c in zip(widths, columns)) + \
+                     " %9s %9s\n" % ('self_ms', 'total_ms'))
+        for name, stats in sorted(self.boards.items(), key=lambda item: -item[1]['self_time']):
+            stream.write("%-16s" % name + ''.join(" %*d" % (w, stats[c]) for w, c in zip(widths, columns)) + \
+                         " %9.1f %9.1f\n" % (stats['self_time'] * 1000, stats['total_time'] * 1000))
+
+    def save(self, filename):
+        boards = {}
+        for name, stats in self.boards.items():
+            stats = dict(stats)
+            stats['cells'] = dict((str(y) + ',' + str(x), count) for (y, x), count in stats['cells'].items())
+            boards[name] = stats
+        with open(filename, 'w') as f:
+            json.dump({'boards': boards}, f, indent=1, separators=(',', ': '), sort_keys=True)
+            f.write('\n')
+
+# what --trace writes, a line of JSON for each event:
+#   {"e":"board","b":name,"devices":[[cell,...],...]} the first time a board runs
+#   {"e":"start","f":frame,"b":name,"d":depth,"T":ticks,"set":[[y,x,marble],...]}
+#   {"e":"tick","f":frame,"t":tick,"T":ticks,"set":[[y,x,marble],...],"clear":[[y,x],...]}
+#   {"e":"finish","f":frame,"t":tick,"T":ticks}
+# where frames are numbered as they start, t counts the frame's own ticks and
+# T the run's, and a tick event has only the cells that changed since the
+# frame's last one, written every nth tick and only if something changed
+class Trace(object):
+    def __init__(self, filename, every=1):
+        self.filename = filename
+        self.every = every
+        self.stream = None
+        self.boards = set()
+        # number and marbles at the last event written of each running frame
+        self.frames = {}
+        self.frame_count = 0
+
+    def event(self, event):
+        if self.stream is None:
+            self.stream = (gzip.open if self.filename.endswith('.gz') else open)(self.filename, 'wb')
+        self.stream.write((json.dumps(event, separators=(',', ':')) + '\n').encode('ascii'))
+
+    def start(self, frame, ticks):
+        board = frame.board
+        if board.name not in self.boards:
+            self.boards.add(board.name)
+            self.event({'e': 'board', 'b': board.name, 'devices': [[format_cell(device) for device in row] for row in board.devices]})
+        self.frame_count += 1
+        self.frames[frame] = (self.frame_count, dict(frame.marbles))
+        self.event({'e': 'start', 'f': self.frame_count, 'b': board.name, 'd': frame.recursion_depth, 'T': ticks,
+                    'set': [[y, x, m] for (y, x), m in sorted(frame.marbles.items())]})
+
+    def tick(self, frame, ticks):
+        if frame.tick_count % self.every:
+            return
+        number, last = self.frames[frame]
+        marbles = frame.marbles
+        changed = [[y, x, m] for (y, x), m in sorted(marbles.items()) if last.get((y, x)) != m]
+        cleared = [[y, x] for y, x in sorted(last) if (y, x) not in marbles]
+        if changed or cleared:
+            self.event({'e': 'tick', 'f': number, 't': frame.tick_count, 'T': ticks, 'set': changed, 'clear': cleared})
+            self.frames[frame] = (number, dict(marbles))
+
+    def finish(self, frame, ticks):
+        number, last = self.frames.pop(frame)
+        self.event({'e': 'finish', 'f': number, 't': frame.tick_count, 'T': ticks})
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+# ticks a frame until it finishes, returning the ticks taken or None if it
+# was still running after max_ticks
+def run_frame(frame, max_ticks=None):
+    scheduler = Scheduler(frame, max_ticks=max_ticks)
+    while scheduler.step():
+        if max_ticks is not None and scheduler.ticks > max_ticks:
+            return None
+    return scheduler.ticks
+
+# parses one input for the main board, a decimal number or a character
+def parse_input(x):
+    return int(x) if x.isdigit() else ord(x)
+
+# identifies the contents of a source file, for the program cache
+def source_digest(text):
+    if not isinstance(text, bytes):  # python 3.x str
+        text = text.encode('utf-8')
+    return hashlib.sha1(text).hexdigest()
+
+# a loaded program, the pristine boards from its source and every file it
+# includes, which can be run any number of times
+class Program(object):
+    def __init__(self, options=None):
+        self.options = dict(default_options)
+        if options:
+            unknown = set(options) - set(default_options)
+            if unknown:
+                raise TypeError("unknown options: " + ', '.join(sorted(unknown)))
+            self.options.update(options)
+        if self.options['numpy'] and not import_numpy():
+            raise MarbelousError("the numpy backend needs numpy installed")
+        self.filename = None
+        # the boards hash contains pristine instances of boards from the source
+        self.boards = {}
+        self.files_included = set()
+        # (filename, mtime, size, sha1) of every file read, and of every
+        # include searched for but not found with None for the rest, see
+        # load_cached
+        self.sources = []
+        self.memo_filenames = {}
+        # what runs have done so far, with the profile option
+        self.profile = Profile() if self.options['profile'] else None
+        # where runs write their --trace events
+        self.trace = Trace(self.options['trace'], self.options['trace_every']) if self.options['trace'] else None
+        # problems with the program that don't stop it running
+        self.warnings = []
+        # the runs going on, see stop
+        self.executions = weakref.WeakSet()
+        self.pool = None
+
+    def __repr__(self):
+        return "Program name=" + self.name()
+
+    def name(self):
+        return self.filename if self.filename is not None else '<text>'
+
+    def load_mbl_file(self, filename, ignore_main=True):
+        if filename in self.files_included:
+            return []
+        self.files_included.add(filename)
+        st = os.stat(filename)
         with open(filename) as f:
-            for line in f.readlines():
-                line = line.rstrip()
-                if len(line)>9 and line[0:9] == "#include ":
-                    # search for include files, in order:
-                    # 1. mbl file's directory
-                    # 2. working directory
-                    # 3. working directory /lib
-                    # 3. interpreter directory /lib
-                    include_dirs = {
-                        os.path.dirname(options['file']),
-                        os.getcwd(),
-                        os.path.join(os.getcwd(),'lib'),
-                        os.path.join(os.path.realpath(__file__),'lib'),
-                    }
-                    include_file = line[9:]
-                    for dir in include_dirs:
-                        filename = os.path.join(dir,include_file)
-                        if os.path.isfile(filename):
-                            lines.extend(load_mbl_file(filename))
-                            break
-                if ignore_main and not main_skipped:
-                    if len(line) > 0 and line[0] == ':':
-                        main_skipped = True
-                    else:
-                        continue
-                if len(line) <2 or line[0] == '#':  # comment
+            file_lines = f.readlines()
+        digest = source_digest(''.join(file_lines))
+        self.sources.append((filename, st.st_mtime, st.st_size, digest))
+        return self.load_mbl_lines(file_lines, ignore_main)
+
+    def load_mbl_lines(self, file_lines, ignore_main=True):
+        lines = []
+        main_skipped = False
+        for line in file_lines:
+            line = line.rstrip()
+            if len(line)>9 and line[0:9] == "#include ":
+                # search for include files, in order:
+                # 1. mbl file's directory
+                # 2. working directory
+                # 3. working directory /lib
+                # 3. interpreter directory /lib
+                include_dirs = {
+                    os.path.dirname(self.filename or ''),
+                    os.getcwd(),
+                    os.path.join(os.getcwd(),'lib'),
+                    os.path.join(os.path.realpath(__file__),'lib'),
+                }
+                include_file = line[9:]
+                for dir in include_dirs:
+                    filename = os.path.join(dir,include_file)
+                    if os.path.isfile(filename):
+                        lines.extend(self.load_mbl_file(filename))
+                        break
+                    # the program cache is stale if this turns up later
+                    self.sources.append((filename, None, None, None))
+            if ignore_main and not main_skipped:
+                if len(line) > 0 and line[0] == ':':
+                    main_skipped = True
+                else:
                     continue
-                lines.append(line)
-    return lines
-
-loaded_lines = load_mbl_file(options['file'],ignore_main=False)
-
-thisboard = Board()
-boardname = "MB"
-boards[boardname] = thisboard
-thisboard.name = boardname
-parse_lines = []
-for line in loaded_lines:
-    if line[0] == ':':  # start of new named board
-        thisboard.parse(parse_lines)
-        thisboard = Board()
-        boardname = line[1:].rstrip()
+            if len(line) <2 or line[0] == '#':  # comment
+                continue
+            lines.append(line)
+        return lines
+
+    def load(self, filename):
+        self.filename = filename
+        cache_filename = None
+        if self.options['program_cache']:
+            # includes are searched for from the working directory too
+            key = os.path.abspath(filename) + '\n' + os.getcwd()
+            cache_filename = os.path.join(self.cache_dir(), hashlib.sha1(key.encode()).hexdigest() + '.program')
+            if self.load_cached(cache_filename):
+                self.prepare()
+                return
+        self.parse(self.load_mbl_file(filename, ignore_main=False))
+        if cache_filename:
+            self.save_cached(cache_filename)
+        self.prepare()
+
+    def load_text(self, text):
+        self.parse(self.load_mbl_lines(text.splitlines(), ignore_main=False))
+        self.prepare()
+
+    # loads the boards parsed by an earlier run, if none of the files they
+    # came from has changed since, returning whether it did
+    def load_cached(self, cache_filename):
+        if not trusted_file(cache_filename):
+            return False
+        try:
+            with open(cache_filename, 'rb') as f:
+                format, sources, board_states, warnings = pickle.load(f)
+        except (IOError, OSError, EOFError, ValueError, pickle.UnpicklingError):
+            return False
+        if format != cache_format or sources_changed(sources):
+            return False
+        for state in board_states:
+            b = Board(self)
+            b.__dict__.update(state)
+            self.boards[b.name] = b
+        self.sources = sources
+        self.warnings = warnings
+        self.files_included = set(filename for filename, mtime, size, digest in sources if digest is not None)
+        return True
+
+    def save_cached(self, cache_filename):
+        try:
+            cache_dir = os.path.dirname(cache_filename)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir, 0o700)
+            fd, temp_filename = tempfile.mkstemp(dir=cache_dir)
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((cache_format, self.sources, [b.parsed_state() for b in self.boards.values()], self.warnings),
+                            f, pickle.HIGHEST_PROTOCOL)
+            os.rename(temp_filename, cache_filename)
+        except (IOError, OSError):
+            pass  # parsing again next time is fine
+
+    # directory for cached programs and precompiled tables
+    def cache_dir(self):
+        return self.options['cache_dir'] or user_cache_dir()
+
+    def parse(self, loaded_lines):
+        boards = self.boards
+        thisboard = Board(self)
+        boardname = "MB"
         boards[boardname] = thisboard
         thisboard.name = boardname
         parse_lines = []
-    else:  # another line in the current board
-        parse_lines.append(line)
-thisboard.parse(parse_lines)
-
-# can't process function devices before all the functions in the file are loaded
-for b in boards.values():
-    b.find_functions()
-
-# make a copy of board zero as the main board
-board = copy.deepcopy(boards['MB'])
-
-if len(options['inputs']) != len(board.inputs):
-    sys.stderr.write(options['file'] + " expects " + str(len(board.inputs)) + " inputs, you gave " + str(len(options['inputs'])) + "\n")
-    exit(1)
-
-board.populate_inputs(dict(enumerate([(int(x) if x.isdigit() else ord(x)) for x in options['inputs']])))
-
-if options['verbose'] > 2:
-    board.display_tick()
-
-total_ticks = 1
-while board.tick():# and board.tick_count < 10000:
-    total_ticks += 1
-    if options['verbose'] > 2:
-        board.display_tick()
-
-if options['verbose'] > 1:
-    board.printr("Total ticks across all boards: " + str(total_ticks))
-
-if options['verbose'] > 0:
-    board.printr("Combined STDOUT: " + ' '.join(["0x" + hex(ord(v))[2:].upper().zfill(2) + \
-                '/"' + (v if ord(v) > 31 else '?') + '"' \
-                for v in board.print_out]))
-
-outputs = board.get_output_values()
-if options['verbose'] > 0:
-    if len(board.outputs):
-        out_str = "MB Outputs: " + \
-            ' '.join(['{' + str(n) + '=' + \
-                str(v) + "/0x" + hex(v)[2:].upper().zfill(2) + \
-                '/"' + (chr(v) if v > 31 else '?') + '"' \
-                for n,v in sorted(outputs.iteritems())])
-        print out_str
-
-if options['return']:
-    if len(board.outputs):
-        if 0 in outputs:
-            exit_code = outputs[0]
+        for line in loaded_lines:
+            if line[0] == ':':  # start of new named board
+                thisboard.parse(parse_lines)
+                thisboard = Board(self)
+                boardname = line[1:].rstrip()
+                boards[boardname] = thisboard
+                thisboard.name = boardname
+                parse_lines = []
+            else:  # another line in the current board
+                parse_lines.append(line)
+        thisboard.parse(parse_lines)
+
+        # can't process function devices before all the functions in the file are loaded
+        trie = self.function_trie()
+        for b in boards.values():
+            b.find_functions(trie)
+        for b in boards.values():
+            b.deterministic = not any(boards[name].has_stdin or boards[name].has_random for name in b.dependencies())
+
+    # builds a trie of the names function devices are written with, each
+    # board's name repeated across its width, one nested hash per character
+    # with the board name under None where a device name ends, and notes
+    # the names that clash
+    def function_trie(self):
+        trie = {}
+        wide_names = {}
+        for b in self.boards.values():
+            wide_name = b.name * (2 * b.function_width // len(b.name))
+            if wide_name in wide_names:
+                self.warnings.append("Boards " + wide_names[wide_name] + " and " + b.name + " are both written " + \
+                                     wide_name + ", using " + b.name)
+            wide_names[wide_name] = b.name
+            node = trie
+            for char in wide_name:
+                node = node.setdefault(char, {})
+            node[None] = b.name
+        # matching stops at the first name that ends on a cell boundary
+        for wide_name, name in sorted(wide_names.items()):
+            node = trie
+            for i, char in enumerate(wide_name[:-1]):
+                node = node[char]
+                if i % 2 == 1 and None in node:
+                    self.warnings.append("Board " + name + " can never be used, " + wide_name + \
+                                         " starts with " + node[None] + "'s " + wide_name[:i+1])
+                    break
+        return trie
+
+    # gets loaded boards ready to run
+    def prepare(self):
+        boards = self.boards
+        # warm the memo tables from earlier runs
+        options = self.options
+        if options['memo_dir']:
+            if not os.path.isdir(options['memo_dir']):
+                os.makedirs(options['memo_dir'])
+            for b in boards.values():
+                filename = b.memo_filename()
+                if filename:
+                    self.memo_filenames[b.name] = filename
+                    b.memoize.load(filename)
+
+        for b in boards.values():
+            b.analyze()
+        if options['jit']:
+            for name in boards['MB'].dependencies():
+                boards[name].transpile()
+        if options['precompile'] and options['verbose'] == 0:
+            self.precompile()
+
+    # replaces pure boards used by the main board with lookup tables, callees
+    # first so their tables speed up evaluating their callers
+    def precompile(self):
+        options = self.options
+        cache_dir = self.cache_dir()
+        precompiled = set(['MB'])
+        def precompile_tree(b):
+            precompiled.add(b.name)
+            for y, x, name in b.functions:
+                if name not in precompiled:
+                    precompile_tree(self.boards[name])
+            if len([n for n in b.inputs if b.inputs[n] is not None]) <= options['precompile']:
+                b.precompile(cache_dir)
+        for y, x, name in self.boards['MB'].functions:
+            if name not in precompiled:
+                precompile_tree(self.boards[name])
+
+    # whether the main board or anything it calls has stdin devices
+    def reads_stdin(self):
+        return any(self.boards[name].has_stdin for name in self.boards['MB'].dependencies())
+
+    # pool of worker processes for function calls, started on first use so
+    # the workers fork with the loaded boards and memos
+    def worker_pool(self):
+        # calls made in workers would be missing from a verbose trace or profile
+        if self.pool is None and self.options['jobs'] > 1 and self.options['verbose'] == 0 and \
+                self.profile is None and self.trace is None:
+            self.pool = multiprocessing.Pool(self.options['jobs'], init_worker, (self,))
+        return self.pool
+
+    def close_pool(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+    def close(self):
+        self.close_pool()
+        if self.trace is not None:
+            self.trace.close()
+
+    # runs the main board once, stdin is the bytes its stdin devices read or
+    # an Input, stdout a stream to write to as it runs, or None
+    # to collect what it writes in Result.stdout
+    def run(self, inputs=(), stdin=b'', stdout=None):
+        return self.start(inputs, stdin, stdout).finish()
+
+    # sets up a run as for run, returning the Execution to advance it with
+    def start(self, inputs=(), stdin=b'', stdout=None):
+        main_board = self.boards['MB']
+        if len(inputs) != len(main_board.inputs):
+            raise MarbelousError(self.name() + " expects " + str(len(main_board.inputs)) + " inputs, you gave " + str(len(inputs)))
+        input_values = [parse_input(x) if isinstance(x, str) else x for x in inputs]
+        if isinstance(stdin, bytes):
+            stdin = Input(stdin)
+        run = Run(self, stdin, BytesIO() if stdout is None else stdout, profile=self.profile, trace=self.trace)
+        if self.profile is not None:
+            self.profile.count_call('MB', 'unmemoized')
+
+        frame = Frame(main_board, run)
+        frame.populate_inputs(dict(enumerate(input_values)))
+        return Execution(self, run, Scheduler(frame, self.worker_pool()), stdout is None)
+
+    # carries on the run a snapshot was taken of, stdin and stdout as for run,
+    # with stdin read by then but not taken yet in front
+    def resume(self, snapshot, stdin=b'', stdout=None):
+        if snapshot['format'] != snapshot_format or snapshot['program'] != self.digest():
+            raise MarbelousError("the snapshot is of a different program, or an older interpreter")
+        if isinstance(stdin, bytes):
+            stdin = Input(stdin)
+        stdin.unread(snapshot['stdin'])
+        run = Run(self, stdin, BytesIO() if stdout is None else stdout, profile=self.profile, trace=self.trace)
+        if stdout is None:
+            run.stdout.write(snapshot['stdout'])
+
+        frames = []
+        for parent, coordinates, name, state in snapshot['frames']:
+            frame = Frame(self.boards[name], run)
+            frame.restore(state)
+            if parent is not None:
+                frames[parent].function_queue.append((frame, coordinates))
+            frames.append(frame)
+        for name, entries in snapshot['memos'].items():
+            for key, value in entries:
+                self.boards[name].memoize.put(key, value)
+        for name in snapshot['has_stdout']:
+            self.boards[name].has_stdout = True
+        random.setstate(snapshot['random'])
+        scheduler = Scheduler(frames[0], self.worker_pool())
+        scheduler.ticks = snapshot['ticks']
+        return Execution(self, run, scheduler, stdout is None).finish()
+
+    # makes every run going on stop with a snapshot at the end of its tick,
+    # safe to call from a signal handler, Execution.stop stops just one
+    def stop(self, reason):
+        for execution in list(self.executions):
+            execution.stop(reason)
+
+    # identifies the boards of a program, for resume
+    def digest(self):
+        digest = hashlib.sha1(str(snapshot_format).encode())
+        for name, b in sorted(self.boards.items()):
+            digest.update((name + '\n' + b.source + '\n').encode())
+        return digest.hexdigest()
+
+    # everything resume needs to carry on a run, from between two steps
+    def snapshot(self, run, scheduler, captured):
+        # the main board and the calls it's waiting on, parents first, and
+        # flat so deep recursion doesn't hit the recursion limit in pickle
+        frames = []
+        pending = [(None, None, scheduler.stack[0])]
+        while pending:
+            parent, coordinates, frame = pending.pop()
+            frames.append((parent, coordinates, frame.board.name, frame.state()))
+            # calls that worker processes were evaluating are run again
+            pending.extend((len(frames)-1, c, f) for f, c in reversed(frame.function_queue))
+        return {
+            'format': snapshot_format,
+            'program': self.digest(),
+            'frames': frames,
+            'ticks': scheduler.ticks,
+            'memos': dict((name, list(b.memoize.entries.items())) for name, b in self.boards.items() if len(b.memoize)),
+            'has_stdout': [name for name, b in self.boards.items() if b.has_stdout],
+            'random': random.getstate(),
+            'stdin': run.stdin.pending(),
+            'stdout': run.stdout.getvalue() if captured else b'',
+            }
+
+    # saves memo tables for later runs
+    def save_memos(self):
+        for name, filename in self.memo_filenames.items():
+            if self.boards[name].memoize.dirty:
+                self.boards[name].memoize.save(filename)
+
+    # reports how well the memo tables did
+    def write_memo_stats(self, stream):
+        for name, b in sorted(self.boards.items()):
+            memo = b.memoize
+            if memo.hits or memo.misses or len(memo):
+                stream.write("Memo " + name + ": " + str(memo.hits) + " hits, " + str(memo.misses) + " misses, " + \
+                             str(memo.evictions) + " evictions, " + str(len(memo)) + " entries\n")
+
+    # writes what Board.analyze found for the boards the main board uses,
+    # the devices no marble can reach, and the boards it never calls
+    def write_analysis(self, stream):
+        used = self.boards['MB'].dependencies()
+        for name in ['MB'] + sorted(used - set(['MB'])):
+            b = self.boards[name]
+            cells = [(y, x) for y, row in enumerate(b.devices) for x, device in enumerate(row) if device not in (None, '..', '  ')]
+            # all the cells of a function device that gets called are used,
+            # as are portals marbles come out of
+            live = set((y, x+i) for y, x, sub_name in b.callable for i in range(self.boards[sub_name].function_width))
+            for portals in b.portals.values():
+                for y, x in portals:
+                    if any(p != (y, x) and p in b.reachable for p in portals):
+                        live.add((y, x))
+            dead = [(y, x) for y, x in cells if (y, x) not in b.reachable and (y, x) not in live]
+            line = "Board " + name + ": " + str(len(cells) - len(dead)) + " of " + str(len(cells)) + " devices reachable, "
+            if b.tick_bound is None:
+                line += "may run forever"
+            else:
+                line += "finishes within " + str(b.tick_bound) + " ticks"
+                estimate = b.estimate_ticks()
+                if b.callable:
+                    line += ", " + ("may run forever" if estimate is None else str(estimate) + " ticks") + " with its calls"
+            stream.write(line + "\n")
+            if dead:
+                stream.write("  dead: " + ', '.join(b.devices[y][x] + " at " + str(y) + "," + str(x) for y, x in dead) + "\n")
+            for number, feeds in sorted(b.feeds.items()):
+                y, x = b.outputs[number][0]
+                stream.write("  " + b.devices[y][x] + " fed by " + str(len(feeds)) + " cells\n")
+        estimate = self.boards['MB'].estimate_ticks()
+        stream.write("Program: " + ("may run forever" if estimate is None else "at most " + str(estimate) + " ticks") + "\n")
+        unused = sorted(set(self.boards) - used)
+        if unused:
+            stream.write("Unused boards: " + ' '.join(unused) + "\n")
+
+# a run under way, which Program.start returns for the caller to advance a
+# slice of steps at a time, or to the end with finish
+class Execution(object):
+    def __init__(self, program, run, scheduler, captured):
+        self.program = program
+        self.run = run
+        self.scheduler = scheduler
+        # whether run.stdout is a BytesIO collecting stdout for the Result
+        self.captured = captured
+        options = program.options
+        self.max_ticks = None
+        if options['max_ticks'] is not None:
+            self.max_ticks = scheduler.max_ticks = scheduler.ticks + options['max_ticks']
+        self.started = time.time()
+        # ticks when the time and memory budgets are checked next
+        self.next_check = scheduler.ticks + budget_check_ticks if options['max_time'] or options['max_memory'] else float('inf')
+        # what the run left behind, once it has finished
+        self.result = None
+        # why the run has to stop, see stop
+        self.stopping = None
+        program.executions.add(self)
+
+        if options['verbose'] > 2:
+            scheduler.display()
+
+    # steps the run until its main board finishes, or for at most steps
+    # steps, returning whether it finished, and raising Stopped if it goes
+    # over a budget or stop is called
+    def advance(self, steps=None):
+        program = self.program
+        options = program.options
+        scheduler = self.scheduler
+        try:
+            for _ in itertools.repeat(None) if steps is None else itertools.repeat(None, steps):
+                if not scheduler.step():
+                    program.executions.discard(self)
+                    self.run.output.flush()
+                    self.result = Result(scheduler.stack[0], scheduler.ticks, self.run.stdout.getvalue() if self.captured else None)
+                    return True
+                if options['verbose'] > 2:
+                    scheduler.display()
+                if scheduler.ticks >= self.next_check or scheduler.waiting:
+                    self.next_check = scheduler.ticks + budget_check_ticks
+                    if options['max_time'] and time.time() - self.started >= options['max_time']:
+                        self.stop("ran out of its " + str(options['max_time']) + " second budget")
+                    elif options['max_memory'] and memory_used() >= options['max_memory']:
+                        self.stop("ran out of its " + str(options['max_memory']) + " MB budget")
+                if self.max_ticks is not None and scheduler.ticks >= self.max_ticks:
+                    self.stop("ran out of its " + str(options['max_ticks']) + " tick budget")
+                if self.stopping is not None:
+                    reason = self.stopping
+                    self.stopping = None
+                    program.executions.discard(self)
+                    if scheduler.evaluating():
+                        # the calls are run again on resume, and may never finish
+                        program.close_pool()
+                    self.run.output.flush()
+                    raise Stopped(program.name() + " stopped on tick " + str(scheduler.ticks) + ": " + reason,
+                                  program.snapshot(self.run, scheduler, self.captured))
+            return False
+        finally:
+            self.run.output.flush()
+
+    # makes the run stop with a snapshot at the end of its tick, safe to call
+    # from a signal handler or another task
+    def stop(self, reason):
+        self.stopping = reason
+
+    # advances the run to the end, returning its Result
+    def finish(self):
+        self.advance()
+        return self.result
+
+# what one run of a program left behind
+class Result(object):
+    def __init__(self, frame, ticks, stdout):
+        # the main board's frame as it finished
+        self.frame = frame
+        # hash of output number:value for the main board's filled outputs
+        self.outputs = frame.get_output_values()
+        # what the run wrote to stdout, None if it went to a stream
+        self.stdout = stdout
+        # total ticks across all boards
+        self.ticks = ticks
+
+    def __repr__(self):
+        return "Result outputs=" + str(self.outputs) + " ticks=" + str(self.ticks)
+
+    # value the main board returns as its process return code with -r
+    def return_code(self):
+        if len(self.frame.board.outputs) and 0 in self.outputs:
+            return self.outputs[0]
+        return 0
+
+# peak memory the interpreter has used, in megabytes
+def memory_used():
+    import resource # for the memory budget, unix only
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1048576.0 if sys.platform == 'darwin' else maxrss / 1024.0  # bytes on macOS, KB elsewhere
+
+def save_snapshot(snapshot, filename):
+    # write to a temporary file first so a run stopped again never leaves half a file
+    fd, temp_filename = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)))
+    with os.fdopen(fd, 'wb') as f:
+        with gzip.GzipFile(fileobj=f, mode='wb') as z:
+            pickle.dump(snapshot, z, pickle.HIGHEST_PROTOCOL)
+    os.rename(temp_filename, filename)
+
+def load_snapshot(filename):
+    try:
+        with gzip.open(filename, 'rb') as z:
+            return pickle.load(z)
+    except (IOError, OSError, EOFError, pickle.UnpicklingError) as e:
+        raise MarbelousError("can't load snapshot " + filename + ": " + str(e))
+
+# whether any of the files a program was loaded from, as Program.sources
+# lists them, has changed or turned up since
+def sources_changed(sources):
+    for filename, mtime, size, digest in sources:
+        if digest is None:
+            if os.path.isfile(filename):
+                return True
+            continue
+        try:
+            st = os.stat(filename)
+            if (st.st_mtime, st.st_size) != (mtime, size):
+                # touched, but maybe not changed
+                with open(filename) as f:
+                    if source_digest(f.read()) != digest:
+                        return True
+        except (IOError, OSError):
+            return True
+    return False
+
+# loads a program from a file name, or from its source if that has more
+# than one line, options are any of default_options
+def load_program(path_or_text, **options):
+    program = Program(options)
+    if '\n' in path_or_text:
+        program.load_text(path_or_text)
+    else:
+        program.load(path_or_text)
+    return program
+
+# runs the main board for one set of batch inputs, returning the results as
+# a line of JSON
+def run_batch_line(program, input_values, stdin=b''):
+    try:
+        result = program.run(input_values, stdin)
+    except Stopped as e:  # over a budget, the rest of the batch can still run
+        return json.dumps({'inputs': input_values, 'stopped': str(e)}, sort_keys=True)
+    stdout_str = result.stdout
+    if isinstance(stdout_str, bytes):
+        stdout_str = stdout_str.decode('latin-1')  # marbles are bytes, not text
+    return json.dumps({
+        'inputs': input_values,
+        'stdout': stdout_str,
+        'outputs': dict((str(n), v) for n, v in result.outputs.items()),
+        'return': result.return_code(),
+        'ticks': result.ticks,
+        }, sort_keys=True)
+
+# run_batch_line for worker processes
+def evaluate_batch_line(input_values):
+    return run_batch_line(worker_program, input_values)
+
+# every set of inputs a batch runs the main board with
+def batch_input_values(program, options):
+    input_count = len(program.boards['MB'].inputs)
+    if options['batch_range']:
+        try:
+            start, stop = [int(n) for n in options['batch_range'].split(':')]
+        except ValueError:
+            raise MarbelousError("--batch-range expects START:STOP, two whole numbers, you gave " + options['batch_range'])
+        return [list(values) for values in itertools.product(range(start, stop), repeat=input_count)]
+    batch = []
+    try:
+        if options['batch'] == '-':
+            lines = sys.stdin.readlines()
+        else:
+            with open(options['batch']) as f:
+                lines = f.readlines()
+    except (IOError, OSError) as e:
+        raise MarbelousError("can't read batch file " + options['batch'] + ": " + str(e))
+    for line_number, line in enumerate(lines):
+        if not line.strip():
+            continue
+        values = [parse_input(x) for x in line.split()]
+        if len(values) != input_count:
+            raise MarbelousError(options['batch'] + " line " + str(line_number+1) + ": " + options['file'] + " expects " + \
+                                 str(input_count) + " inputs, you gave " + str(len(values)))
+        batch.append(values)
+    return batch
+
+# saves memo tables and writes the reports asked for on the command line
+def finish_program(program, options):
+    program.save_memos()
+    if options['memo_stats']:
+        program.write_memo_stats(sys.stderr if options['stderr'] else sys.stdout)
+    if program.profile is not None:
+        program.profile.report(sys.stderr)
+        program.profile.save(options['profile'])
+
+def main(argv=None):
+    options = vars(parser.parse_args(argv))
+    try:
+        program = load_program(options['file'], **dict((k, options[k]) for k in default_options))
+        if options['batch'] or options['batch_range']:
+            batch = batch_input_values(program, options)
+    except MarbelousError as e:
+        sys.stderr.write(str(e) + "\n")
+        exit(1)
+    for warning in program.warnings:
+        sys.stderr.write("Warning: " + warning + "\n")
+    if options['analyze']:
+        program.write_analysis(sys.stdout)
+        program.close()
+        exit(0)
+
+    stdin = b''
+    # batch inputs on stdin can't be read by boards too
+    if options['batch'] != '-' and program.reads_stdin():
+        stdin = open_input(sys.stdin)
+
+    if options['batch'] or options['batch_range']:
+        # worker processes fork from here, sharing the loaded boards and memos
+        pool = program.worker_pool()
+        if pool is not None:
+            results = pool.imap(evaluate_batch_line, batch, max(1, len(batch) // (options['jobs'] * 4)))
         else:
-            exit_code = 0
-        exit(exit_code)
+            results = (run_batch_line(program, input_values, stdin) for input_values in batch)
+        for line in results:
+            sys.stdout.write(line + '\n')
+        program.close()
+        finish_program(program, options)
+        exit(0)
+
+    # a terminated run still writes the stdout it has buffered, Program.run
+    # flushes it on the way out, or stops at the end of its tick to save a
+    # snapshot
+    if options['snapshot']:
+        signal.signal(signal.SIGTERM, lambda signum, frame: program.stop("terminated by signal " + str(signum)))
+    else:
+        signal.signal(signal.SIGTERM, lambda signum, frame: exit(128 + signum))
+    try:
+        if options['resume']:
+            result = program.resume(load_snapshot(options['resume']), stdin, sys.stdout)
+        else:
+            result = program.run(options['inputs'], stdin, sys.stdout)
+    except Stopped as e:
+        program.close()
+        finish_program(program, options)
+        if options['snapshot']:
+            save_snapshot(e.snapshot, options['snapshot'])
+            sys.stderr.write(str(e) + ", saved a snapshot in " + options['snapshot'] + "\n")
+        else:
+            sys.stderr.write(str(e) + "\n")
+        exit(1)
+    except MarbelousError as e:
+        sys.stderr.write(str(e) + "\n")
+        exit(1)
+    except SystemExit as e:
+        # leave straight away, the signal also killed any worker processes
+        # and shutting down their pool could wait on locks they held
+        if program.trace is not None:
+            program.trace.close()
+        os._exit(e.code)
+    program.close()
+    frame = result.frame
+
+    if options['verbose'] > 1:
+        frame.printr("Total ticks across all boards: " + str(result.ticks))
+
+    finish_program(program, options)
+
+    if options['verbose'] > 0:
+        frame.printr("Combined STDOUT: " + ' '.join(["0x" + hex(ord(v))[2:].upper().zfill(2) + \
+                    '/"' + (v if ord(v) > 31 else '?') + '"' \
+                    for v in frame.print_out]))
+
+    outputs = result.outputs
+    if options['verbose'] > 0:
+        if len(frame.board.outputs):
+            out_str = "MB Outputs: " + \
+                ' '.join(['{' + str(n) + '=' + \
+                    str(v) + "/0x" + hex(v)[2:].upper().zfill(2) + \
+                    '/"' + (chr(v) if v > 31 else '?') + '"' \
+                    for n,v in sorted(outputs.items())])
+            print(out_str)
+
+    if options['return']:
+        if len(frame.board.outputs):
+            exit(result.return_code())
+
+    print('')
 
-print
\ No newline at end of file
+if __name__ == '__main__':
+    main()
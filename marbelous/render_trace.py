@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# renders the boards in a trace written by marbelous.py --trace, one full
+# board for every tick the trace has and one as each frame finishes, as
+# marbelous.py -vvv displays them
+
+import sys
+import gzip
+import json
+import argparse
+
+parser = argparse.ArgumentParser(description='Render a Marbelous trace.')
+parser.add_argument('trace', metavar='trace.jsonl',
+                    help='trace written by marbelous.py --trace, gzipped if it ends in .gz')
+parser.add_argument('-b', '--board', metavar='NAME', dest='board', action='store',
+                    help='only render frames of board NAME')
+parser.add_argument('-f', '--frame', metavar='N', dest='frame', action='store', type=int,
+                    help='only render frame N, frames are numbered as they start')
+parser.add_argument('--ticks', metavar='START:STOP', dest='ticks', action='store',
+                    help='only render events from total tick START to STOP-1')
+
+def format_cell(x):
+    return hex(x)[2:].upper().zfill(2) if type(x) is int else x.ljust(2)
+
+# writes a frame's board with its marbles on, indented by its call depth
+def render(stream, devices, name, depth, tick, marbles):
+    indent = ' ' * depth
+    stream.write(indent + ':' + name + ' tick ' + str(tick) + '\n')
+    for y, row in enumerate(devices):
+        stream.write(indent + ''.join(format_cell(marbles.get((y, x), device)) + ' ' for x, device in enumerate(row)) + '\n')
+    stream.write(indent + '\n')
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    start, stop = 0, None
+    if args.ticks:
+        start, stop = [int(n) if n else None for n in args.ticks.split(':')]
+        start = start or 0
+    devices = {}
+    # name, depth and marbles of every running frame
+    frames = {}
+    f = (gzip.open if args.trace.endswith('.gz') else open)(args.trace, 'rb')
+    for line in f:
+        event = json.loads(line.decode('ascii'))
+        kind = event['e']
+        if kind == 'board':
+            devices[event['b']] = event['devices']
+            continue
+        number = event['f']
+        if kind == 'start':
+            frames[number] = (event['b'], event['d'], dict(((y, x), m) for y, x, m in event['set']))
+        elif kind == 'tick':
+            marbles = frames[number][2]
+            for y, x in event['clear']:
+                del marbles[(y, x)]
+            for y, x, m in event['set']:
+                marbles[(y, x)] = m
+        # a finish event shows the board as the frame finished
+        name, depth, marbles = frames.pop(number) if kind == 'finish' else frames[number]
+        tick = event.get('t', 0)
+        if args.board is not None and name != args.board or args.frame is not None and number != args.frame:
+            continue
+        if event['T'] < start or stop is not None and event['T'] >= stop:
+            continue
+        render(sys.stdout, devices[name], name, depth, tick, marbles)
+    f.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+# asyncio interface to the interpreter, for python 3.6 and later: a run is a
+# task reading its stdin devices' bytes from an asyncio stream and handing
+# over its stdout as it's written, giving way to the event loop every few
+# ticks so many runs can share one thread
+
+import asyncio
+
+from .marbelous import Input, input_chunk_size
+
+# steps a run takes between giving way to other tasks
+default_every = 100
+
+# where a streamed run's stdout collects between slices of steps
+class Chunks(object):
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        del self.chunks[:]
+        return data
+
+# a run of a program as an async iterator over the bytes it writes to
+# stdout, stdin is bytes or an asyncio.StreamReader, or anything else with
+# an async read(n), and result is the run's Result once the iterator ends
+#
+#     async for data in Stream(program, [10], reader):
+#         writer.write(data)
+class Stream(object):
+    def __init__(self, program, inputs=(), stdin=b'', every=default_every):
+        self.input = Input(stdin) if isinstance(stdin, bytes) else Input()
+        self.stdin = None if isinstance(stdin, bytes) else stdin
+        self.output = Chunks()
+        self.execution = program.start(inputs, self.input, self.output)
+        # skipping the laps of a cycle would never give way, so they're
+        # ticked and streamed like any others
+        self.execution.scheduler.watch_cycles = False
+        self.every = every
+        self.reader = None
+        self.result = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.stdin is not None and self.reader is None and self.result is None:
+            self.reader = asyncio.ensure_future(self.read_stdin())
+        while not self.output.chunks:
+            if self.result is not None:
+                raise StopAsyncIteration
+            try:
+                if self.execution.advance(self.every):
+                    self.result = self.execution.result
+                    self.close()
+            except BaseException:
+                self.close()
+                raise
+            await asyncio.sleep(0)  # give way to the other tasks
+        return self.output.take()
+
+    # moves bytes from stdin to the run's Input as they arrive
+    async def read_stdin(self):
+        while True:
+            chunk = await self.stdin.read(input_chunk_size)
+            if not chunk:
+                break
+            self.input.put(chunk)
+
+    # makes this run stop at the end of its tick, the iterator then raises
+    # Stopped, other runs of the program carry on
+    def stop(self, reason):
+        self.execution.stop(reason)
+
+    # stops reading stdin, the run can't use any more
+    def close(self):
+        if self.reader is not None:
+            self.reader.cancel()
+            self.reader = None
+
+# runs a program as a task, returning its Result with all it wrote to stdout
+async def run(program, inputs=(), stdin=b'', every=default_every):
+    stream = Stream(program, inputs, stdin, every)
+    chunks = [data async for data in stream]
+    stream.result.stdout = b''.join(chunks)
+    return stream.result
@@ -0,0 +1,515 @@
+# tests for the interpreter, run with python -m pytest or python -m unittest
+# from the root of the repository
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import inspect
+import random
+import shutil
+import select
+import subprocess
+import tempfile
+import unittest
+from io import BytesIO
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_dir)
+import marbelous.marbelous
+from marbelous.marbelous import load_program, import_numpy, numpy_min_marbles, batch_input_values, Frame, Stopped, MarbelousError
+from marbelous.marbelous import compile_device, OP_FALL, OP_TRASH, OP_BIT, OP_ADD, OP_OUTPUT, Output, flush_size
+from marbelous import daemon
+
+# what the benchmark cases print, see bench/bench.py
+def golden(name):
+    with open(os.path.join(root_dir, 'bench', 'golden', name + '.out'), 'rb') as f:
+        return f.read()
+
+bitwise_operations = os.path.join(root_dir, 'lib', 'bitwise_operations.mbl')
+adder = os.path.join(root_dir, 'examples', 'adder.mbl')
+fibonacci = os.path.join(root_dir, 'examples', 'fibonacci.mbl')
+
+# a marble going round through a portal, printing an A on every lap
+cycling_printer = '41 @0 ..\n.. .. ..\n@0 /\\ [[\n'
+# a marble going round through a portal forever, printing nothing
+quiet_cycle = '@0\n01\n@0\n'
+
+# two calls to a board going round forever, for a worker pool to take
+endless_calls = '01 02\nLp Lp\n:Lp\n}0 @0\n.. //\n@0 ..\n'
+
+# boards the jit's analysis has to be careful with, as (name, source, stdin):
+# marbles carried back up by portals, held by synchronizers, made by random
+# devices and read from stdin, and devices no marble reaches
+jit_boards = [
+    ('portal', '41 @0\n.. ..\n@0 ..\n', b''),
+    ('portal loop', '03 @0 ..\n.. // ..\n-- .. ..\n=0 @0 ..\n.. .. ..\n', b''),
+    ('synchronizer', '41 .. ..\n&0 42 ..\n.. &0 ..\n', b''),
+    ('random', '05 09 00\n?? ?3 ?0\n', b''),
+    ('stdin', '00 00\n]] ]]\n', b'xy'),
+    ('unreachable', '41 .. .. ..\n.. .. ++ 30\n.. .. -- ..\n', b''),
+]
+
+# a main board that prints a 0 and finishes for an input of 0, and goes
+# round forever for any other
+finishes_on_zero = '}0 @0\n.. ..\n=0 @0\n'
+
+# a function device whose second input waits a tick on the device for the
+# first, and prints both
+waiting_call = '41 ..\n.. 42\nAdAd\n:Ad\n}0 }1\n{0 {1\n'
+
+# runs a program until it's stopped, returning why and what it printed
+def stopped_run(program, watch_cycles=True):
+    execution = program.start([], b'')
+    execution.scheduler.watch_cycles = watch_cycles
+    try:
+        execution.finish()
+    except Stopped as e:
+        return str(e), e.snapshot['stdout']
+    raise AssertionError('the run finished')
+
+class TickTest(unittest.TestCase):
+    def test_merging_marbles(self):
+        # marbles moved onto the same cell add up, wrapping at 256
+        for source, stdout in [('80 .. 7F\n\\\\ .. //\n', b'\xff'), ('80 .. 80\n\\\\ .. //\n', b'\x00')]:
+            for jit in [False, True]:
+                result = load_program(source, jit=jit, program_cache=False).run()
+                self.assertEqual((result.stdout, result.ticks), (stdout, 4))
+
+class DeviceTest(unittest.TestCase):
+    def test_compile_device(self):
+        self.assertEqual(compile_device(None), (OP_FALL, 0))
+        self.assertEqual(compile_device('{<'), (OP_OUTPUT, 0))
+        self.assertEqual(compile_device('+Z'), (OP_ADD, 35))
+        self.assertEqual(compile_device('^3'), (OP_BIT, 8))
+        # unrecognized devices and the cells of function devices are trash
+        for device in ['^8', '+a', '=!', 'Ad', 'Fn']:
+            self.assertEqual(compile_device(device), (OP_TRASH, 0), device)
+
+    def test_function_cells(self):
+        # a marble on a function device's cell waits there for the call
+        for jit in [False, True]:
+            program = load_program(waiting_call, jit=jit, program_cache=False)
+            self.assertEqual(program.boards['MB'].opcodes[2].tolist(), [OP_TRASH, OP_TRASH])
+            self.assertEqual(program.run().stdout, b'AB')
+
+class GroupTest(unittest.TestCase):
+    def test_portals(self):
+        board = load_program('41 @0\n.. ..\n@0 @1\n', program_cache=False).boards['MB']
+        self.assertEqual(board.portals, {0: [(0, 1), (2, 0)], 1: [(2, 1)]})
+        self.assertFalse(board.has_random)
+        # a portal with two others to pick from
+        board = load_program('41 @0\n.. @0\n@0 ..\n', program_cache=False).boards['MB']
+        self.assertEqual(board.portals, {0: [(0, 1), (1, 1), (2, 0)]})
+        self.assertTrue(board.has_random)
+
+    def test_synchronizers(self):
+        # the A waits on its synchronizer until the B reaches the other
+        program = load_program('41 42\n&0 ..\n.. ..\n.. &0\n', program_cache=False)
+        self.assertEqual(program.boards['MB'].synchronizers, {0: [(1, 0), (3, 1)]})
+        result = program.run()
+        self.assertEqual((result.stdout, result.ticks), (b'BA', 7))
+
+class FunctionTest(unittest.TestCase):
+    def test_find_functions(self):
+        program = load_program('01 02 03\nXyXyFn\n:Xy\n}0 }1\n{0 ..\n:Fn\n}0\n', program_cache=False)
+        self.assertEqual(program.boards['MB'].functions, [(1, 0, 'Xy'), (1, 2, 'Fn')])
+        self.assertEqual(program.warnings, [])
+
+    def test_same_name(self):
+        program = load_program('01\nQQ\n:Q\n}0\n:QQ\n}0\n', program_cache=False)
+        self.assertEqual(len(program.warnings), 1)
+        self.assertIn(program.warnings[0], ["Boards Q and QQ are both written QQ, using QQ",
+                                            "Boards QQ and Q are both written QQ, using Q"])
+
+    def test_shadowed_name(self):
+        # Ab matches first, so AbCd can't be called
+        program = load_program('01\nAb\n:Ab\n}0\n:AbCd\n}0 }1\n', program_cache=False)
+        self.assertEqual(program.warnings, ["Board AbCd can never be used, AbCd starts with Ab's Ab"])
+        self.assertEqual(program.boards['MB'].functions, [(1, 0, 'Ab')])
+
+class CallTest(unittest.TestCase):
+    def test_calls_start_fresh(self):
+        # each call gets the 05 its board starts with, and the board keeps it
+        program = load_program('01 02\nCn Cn\n:Cn\n}0 05\n{0 {0\n', program_cache=False)
+        self.assertEqual(program.run().stdout, b'\x06\x07')
+        self.assertEqual(program.boards['Cn'].marbles, {(0, 1): 5})
+        self.assertEqual(program.run().stdout, b'\x06\x07')
+
+class SchedulerTest(unittest.TestCase):
+    def test_deep_calls(self):
+        # Rc calls itself until its input counts down to 0, 250 calls deep,
+        # with less Python stack to spare than that
+        program = load_program('}0\nRc\n:Rc\n}0 ..\n=0 -1\n{0 Rc\n.. {0\n', program_cache=False)
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(len(inspect.stack()) + 100)
+        try:
+            result = program.run([250])
+        finally:
+            sys.setrecursionlimit(limit)
+        self.assertEqual(result.stdout, b'\x00')
+
+class FastForwardTest(unittest.TestCase):
+    def test_tick_budget(self):
+        # skipping laps stops on the same tick with the same output
+        for max_ticks in [1, 13, 16, 1000, 20003]:
+            program = load_program(cycling_printer, max_ticks=max_ticks, program_cache=False)
+            self.assertEqual(stopped_run(program), stopped_run(program, watch_cycles=False))
+
+    def test_trace(self):
+        # a traced run ticks through its cycles, so the trace has every tick
+        trace_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(trace_dir, 'trace.json')
+            program = load_program(cycling_printer, max_ticks=1000, trace=filename, program_cache=False)
+            self.assertRaises(Stopped, program.run)
+            program.trace.close()
+            with open(filename) as f:
+                ticks = [event['T'] for event in map(json.loads, f) if event['e'] == 'tick']
+        finally:
+            shutil.rmtree(trace_dir)
+        self.assertEqual(ticks, list(range(2, 1002)))
+
+    def test_time_budget(self):
+        program = load_program(quiet_cycle, max_time=0.2, program_cache=False)
+        reason, stdout = stopped_run(program)
+        self.assertIn('second budget', reason)
+
+    def test_pooled_calls(self):
+        # budgets are checked while waiting on calls in worker processes
+        for budget in [{'max_ticks': 1000}, {'max_time': 0.5}]:
+            program = load_program(endless_calls, jobs=2, program_cache=False, **budget)
+            try:
+                self.assertRaises(Stopped, program.run)
+                self.assertRaises(Stopped, program.run)  # with a new pool
+            finally:
+                program.close()
+
+class StopTest(unittest.TestCase):
+    def test_stop_one_run(self):
+        program = load_program(quiet_cycle, program_cache=False)
+        stopped = program.start([], b'')
+        running = program.start([], b'')
+        stopped.stop('asked to')
+        self.assertRaises(Stopped, stopped.advance, 10)
+        self.assertFalse(running.advance(10))
+
+    def test_finishing_run_keeps_stop(self):
+        # a run that finishes doesn't clear a stop asked of another
+        program = load_program(finishes_on_zero, program_cache=False)
+        stopped = program.start([1], b'')
+        stopped.stop('asked to')
+        self.assertTrue(program.start([0], b'').advance())
+        self.assertRaises(Stopped, stopped.advance, 10)
+
+    def test_program_stop(self):
+        program = load_program(quiet_cycle, program_cache=False)
+        executions = [program.start([], b''), program.start([], b'')]
+        program.stop('asked to')
+        for execution in executions:
+            self.assertRaises(Stopped, execution.advance, 10)
+
+    @unittest.skipIf(sys.version_info < (3, 6), 'streaming needs python 3.6')
+    def test_stop_one_stream(self):
+        import asyncio
+        from marbelous import streaming
+        program = load_program(cycling_printer, program_cache=False)
+        streams = [streaming.Stream(program, every=10) for i in range(2)]
+        loop = asyncio.new_event_loop()
+        try:
+            # both streams print, then one of them is stopped
+            for stream in streams:
+                self.assertEqual(loop.run_until_complete(stream.__anext__())[:1], b'A')
+            streams[0].stop('asked to')
+            self.assertRaises(Stopped, loop.run_until_complete, streams[0].__anext__())
+            self.assertEqual(loop.run_until_complete(streams[1].__anext__())[:1], b'A')
+        finally:
+            loop.close()
+
+class PoolTest(unittest.TestCase):
+    def test_ticks(self):
+        # ticks calls take in worker processes count, the same as here
+        results = []
+        for jobs in [1, 4]:
+            program = load_program(fibonacci, jobs=jobs, memoize_width=0, program_cache=False)
+            try:
+                result = program.run([10])
+            finally:
+                program.close()
+            results.append((result.stdout, result.ticks))
+        self.assertEqual(results[0], results[1])
+
+class SnapshotTest(unittest.TestCase):
+    def test_resume_twice(self):
+        program = load_program(fibonacci, max_ticks=30, program_cache=False)
+        execution = program.start([10])
+        try:
+            execution.finish()
+        except Stopped as e:
+            snapshot = e.snapshot
+        # carrying on the stopped run leaves its snapshot as it was
+        execution.scheduler.step()
+        execution.scheduler.step()
+        program.options['max_ticks'] = None
+        self.assertEqual([program.resume(snapshot).stdout for i in range(2)], [program.run([10]).stdout] * 2)
+
+class InputTest(unittest.TestCase):
+    @unittest.skipUnless(hasattr(os, 'openpty'), 'needs a pseudo terminal')
+    def test_terminal(self):
+        # keys typed in UTF-8 are read as bytes, one marble each
+        master, slave = os.openpty()
+        process = subprocess.Popen([sys.executable, os.path.join(root_dir, 'marbelous', 'marbelous.py'),
+                                    os.path.join(root_dir, 'examples', 'cat.mbl')],
+                                   stdin=slave, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        os.close(slave)
+        try:
+            os.write(master, b'\xc3\xa9x')
+            stdout = b''
+            while len(stdout) < 3 and select.select([process.stdout], [], [], 10)[0]:
+                stdout += os.read(process.stdout.fileno(), 100)
+        finally:
+            os.close(master)
+            process.kill()
+            process.wait()
+            process.stdout.close()
+            process.stderr.close()
+        self.assertEqual(stdout, b'\xc3\xa9x')
+
+class ProgramCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.source_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.source_dir, 'cache')
+        self.main = os.path.join(self.source_dir, 'main.mbl')
+        with open(self.main, 'w') as f:
+            f.write('05\nPr\n#include printer.mbl\n')
+        self.write_printer('}0\n--\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.source_dir)
+
+    def write_printer(self, board):
+        with open(os.path.join(self.source_dir, 'printer.mbl'), 'w') as f:
+            f.write(':Pr\n' + board)
+
+    def load(self):
+        return load_program(self.main, program_cache=True, cache_dir=self.cache_dir)
+
+    def cached_files(self):
+        return [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if name.endswith('.program')]
+
+    def test_included_file_changed(self):
+        self.assertEqual(self.load().run().stdout, b'\x04')
+        self.assertEqual(len(self.cached_files()), 1)
+        self.assertEqual(self.load().run().stdout, b'\x04')
+        self.write_printer('}0\n++\n++\n')
+        self.assertEqual(self.load().run().stdout, b'\x07')
+
+    @unittest.skipUnless(hasattr(os, 'getuid'), 'no file owners')
+    def test_untrusted_cache(self):
+        self.load()
+        cached = self.cached_files()[0]
+        self.assertTrue(marbelous.marbelous.trusted_file(cached))
+        os.chmod(cached, 0o666)
+        self.assertFalse(marbelous.marbelous.trusted_file(cached))
+        os.chmod(cached, 0o600)
+        os.chmod(self.cache_dir, 0o777)
+        self.assertFalse(marbelous.marbelous.trusted_file(cached))
+
+    def test_not_cached_by_default(self):
+        load_program(self.main, cache_dir=self.cache_dir)
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+class OutputTest(unittest.TestCase):
+    # what ends up in a file printed to around stdout written with a policy
+    def interleaved(self, policy):
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            with open(filename, 'w') as f:
+                output = Output(f, policy)
+                print('one', file=f)
+                output.write(b'two\n')
+                print('three', file=f)
+                output.write(b'four')
+                output.flush()
+                print('five', file=f)
+            with open(filename, 'rb') as f:
+                return f.read()
+        finally:
+            os.remove(filename)
+
+    def test_flush_policies(self):
+        # what was printed before a flush is written ahead of it
+        self.assertEqual(self.interleaved('line'), b'one\ntwo\nthree\nfourfive\n')
+        self.assertEqual(self.interleaved('size'), b'one\nthree\ntwo\nfourfive\n')
+        self.assertEqual(self.interleaved('exit'), b'one\nthree\ntwo\nfourfive\n')
+
+    def test_flush_size(self):
+        stream = BytesIO()
+        output = Output(stream, 'size')
+        output.write(b'x' * (flush_size - 1))
+        self.assertEqual(stream.getvalue(), b'')
+        output.write(b'x')
+        self.assertEqual(len(stream.getvalue()), flush_size)
+        exit_output = Output(BytesIO(), 'exit')
+        exit_output.write(b'x' * flush_size)
+        self.assertEqual(exit_output.stream.getvalue(), b'')
+
+class MemoTest(unittest.TestCase):
+    def test_memo_dir(self):
+        # calls the second run finds in the saved memos print in the same
+        # order as the first run's
+        memo_dir = tempfile.mkdtemp()
+        try:
+            stdouts = []
+            for i in range(2):
+                program = load_program(bitwise_operations, memo_dir=memo_dir, program_cache=False)
+                stdouts.append(program.run([12, 10]).stdout)
+                program.save_memos()
+        finally:
+            shutil.rmtree(memo_dir)
+        self.assertEqual(stdouts, [golden('lib_bitwise_operations')] * 2)
+
+class PrecompileTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_table_hits(self):
+        program = load_program(bitwise_operations, precompile=2, cache_dir=self.cache_dir, program_cache=False)
+        self.assertIsNotNone(program.boards['Bnor'].table)
+        self.assertEqual(program.run([12, 10]).stdout, golden('lib_bitwise_operations'))
+
+    def test_table_tick_limit(self):
+        # Plus finishes within 5 ticks, too many for a table of 65536
+        table_total_tick_limit = marbelous.marbelous.table_total_tick_limit
+        marbelous.marbelous.table_total_tick_limit = 65536 * 4
+        try:
+            program = load_program(adder, precompile=2, cache_dir=self.cache_dir, program_cache=False)
+        finally:
+            marbelous.marbelous.table_total_tick_limit = table_total_tick_limit
+        self.assertIsNone(program.boards['Plus'].table)
+        self.assertEqual(program.run([3, 4]).stdout, golden('adder_3_4'))
+
+    def test_stdout_boards(self):
+        # Pd writes stdout, and for inputs below 1 it would write a marble
+        # chr can't make, so it isn't tabulated or marked as writing stdout
+        source = '05\nPd\n:Pd\n}0\n--\n'
+        program = load_program(source, precompile=1, cache_dir=self.cache_dir, program_cache=False)
+        self.assertIsNone(program.boards['Pd'].table)
+        self.assertFalse(program.boards['Pd'].has_stdout)
+        self.assertEqual(program.run().stdout, load_program(source, program_cache=False).run().stdout)
+
+class NumpyTest(unittest.TestCase):
+    @unittest.skipUnless(import_numpy(), 'numpy is not installed')
+    def test_vector_tick(self):
+        # enough columns of marbles falling through incrementers and
+        # deflectors for the vectorized tick to move them
+        width = numpy_min_marbles + 8
+        source = ' '.join(['30'] * width) + '\n' + ' '.join(['++'] * width) + '\n' + ' '.join(['//', '\\\\', '..'] * (width // 3)) + '\n'
+        vector_ticks = []
+        vector_tick = Frame.vector_tick
+        def counted_vector_tick(frame, nmb):
+            vector_ticks.append(frame)
+            return vector_tick(frame, nmb)
+        Frame.vector_tick = counted_vector_tick
+        try:
+            stdout = load_program(source, numpy=True, program_cache=False).run().stdout
+        finally:
+            Frame.vector_tick = vector_tick
+        self.assertTrue(vector_ticks)
+        self.assertEqual(stdout, load_program(source, program_cache=False).run().stdout)
+
+class JitTest(unittest.TestCase):
+    # what a run prints and returns, and the ticks it takes, within a budget
+    # so a board the jit gets wrong can't run forever
+    def run_case(self, source, inputs, stdin, jit):
+        random.seed(0)
+        program = load_program(source, jit=jit, max_ticks=1000000, program_cache=False)
+        result = program.run(inputs, stdin)
+        return result.stdout, result.outputs, result.return_code(), result.ticks
+
+    def test_bench_cases(self):
+        sys.path.insert(0, os.path.join(root_dir, 'bench'))
+        import bench
+        for name, source, inputs in bench.all_cases():
+            if '\n' not in source:
+                source = os.path.join(root_dir, source)
+            self.assertEqual(self.run_case(source, inputs, b'', False), self.run_case(source, inputs, b'', True), name)
+
+    def test_analyzed_boards(self):
+        for name, source, stdin in jit_boards:
+            self.assertIsNotNone(load_program(source, jit=True, program_cache=False).boards['MB'].step, name)
+            self.assertEqual(self.run_case(source, [], stdin, False), self.run_case(source, [], stdin, True), name)
+
+class AnalysisTest(unittest.TestCase):
+    def analyzed(self, name):
+        source = dict((case, source) for case, source, stdin in jit_boards)[name]
+        return load_program(source, program_cache=False).boards['MB']
+
+    def test_portal_pair(self):
+        # the // under the first portal is only reached through the second,
+        # and a marble going round them may never finish
+        board = self.analyzed('portal loop')
+        self.assertIn((3, 1), board.reachable)
+        self.assertIn((1, 1), board.reachable)
+        self.assertEqual(board.tick_bound, None)
+
+    def test_unreachable_region(self):
+        board = self.analyzed('unreachable')
+        self.assertEqual(sorted(board.reachable), [(0, 0), (1, 0), (1, 3), (2, 0), (2, 3)])
+        self.assertNotIn((1, 2), board.reachable)
+        self.assertNotIn((2, 2), board.reachable)
+        self.assertEqual(board.tick_bound, 4)
+
+class ProfileTest(unittest.TestCase):
+    def test_recursive_totals(self):
+        # Fb calls itself, its total is the outermost call's alone
+        program = load_program(fibonacci, memoize_width=0, profile='unused', program_cache=False)
+        ticks = program.run([12]).ticks
+        boards = program.profile.boards
+        self.assertEqual(boards['MB']['total_ticks'], ticks)
+        self.assertLess(boards['Fb']['total_ticks'], ticks)
+        self.assertEqual(boards['Fb']['unmemoized'], boards['Fb']['calls'])
+
+class BatchTest(unittest.TestCase):
+    def test_batch_range(self):
+        program = load_program(adder, program_cache=False)
+        self.assertEqual(batch_input_values(program, {'batch_range': '1:3'}), [[1, 1], [1, 2], [2, 1], [2, 2]])
+        for batch_range in ['3', 'a:b', '1:2:3']:
+            self.assertRaises(MarbelousError, batch_input_values, program, {'batch_range': batch_range})
+
+    def test_batch_file(self):
+        program = load_program(adder, program_cache=False)
+        self.assertRaises(MarbelousError, batch_input_values, program,
+                          {'batch_range': None, 'batch': os.path.join(root_dir, 'no such file')})
+
+class DaemonTest(unittest.TestCase):
+    def test_budget(self):
+        self.assertEqual(daemon.budget(None, 60, 600), 60)
+        self.assertEqual(daemon.budget(10, 60, 600), 10)
+        self.assertEqual(daemon.budget(1000, 60, 600), 600)
+        self.assertEqual(daemon.budget(None, None, 600), 600)
+        self.assertEqual(daemon.budget(None, None, None), None)
+
+    def test_request_error(self):
+        request = {'file': adder, 'cwd': root_dir, 'inputs': ['3', 4]}
+        self.assertIsNone(daemon.request_error(request))
+        for field, value in [('file', None), ('cwd', 1), ('inputs', None), ('inputs', {}), ('inputs', [None]),
+                             ('max_ticks', '10'), ('max_time', []), ('stdin', 1)]:
+            bad = dict(request)
+            bad[field] = value
+            self.assertIsNotNone(daemon.request_error(bad))
+
+    def test_output_limit(self):
+        program = load_program(cycling_printer, program_cache=False, flush='size')
+        output = daemon.CappedOutput(100000)
+        output.execution = program.start([], b'', output)
+        self.assertRaises(Stopped, output.execution.finish)
+        self.assertEqual(output.getvalue(), b'A' * 100000)
+
+if __name__ == '__main__':
+    unittest.main()